@@ -61,6 +61,8 @@ sys.path.append(os.path.join(activity.get_bundle_path(), 'src'))
 
 import UndoManager
 import MMapArea
+import MapSaver
+import AutoSave
 import utils
 
 EMPTY = -800
@@ -667,6 +669,11 @@ class ActionButtons():
 class LabyrinthActivity(activity.Activity):
     def __init__(self, handle):
         activity.Activity.__init__(self, handle)
+        self._saver = None
+        # What the last written map looked like, and the autosave file
+        # holding it if it was written by an autosave
+        self._saved_snapshot = None
+        self._autosave_path = None
 
         if HASTOOLBARBOX:
             self.max_participants = 1
@@ -804,6 +811,8 @@ class LabyrinthActivity(activity.Activity):
                                 self.__text_selection_cb)
         self._main_area.connect("thought_selection_changed",
                                 self.__thought_selected_cb)
+        self._autosave = AutoSave.AutoSave(self.__autosave_cb)
+        self._main_area.connect("map_changed", self._autosave.changed)
         Gdk.Screen.get_default().connect('size-changed',
                                              self.__configure_cb)
 
@@ -1010,6 +1019,33 @@ class LabyrinthActivity(activity.Activity):
         fileObject.destroy()
         del fileObject
 
+    def __autosave_cb(self, done_cb):
+        # Only the map is written, in the background, to a file of our
+        # own; the journal gets it (by copy) on the next write_file
+        if self._saver is not None:
+            # write_file is busy, try again once it is done
+            done_cb()
+            self._autosave.changed()
+            return
+        snapshot = self._main_area.snapshot(self.get_manifest_attributes())
+        if snapshot == self._saved_snapshot:
+            done_cb()
+            return
+        path = os.path.join(self.get_activity_root(), 'instance',
+                            'autosave.map')
+
+        def saved_cb(saver):
+            if self._saver is saver:
+                self._saver = None
+            if saver.error is None:
+                self._saved_snapshot = snapshot
+                self._autosave_path = path
+            done_cb()
+
+        self._saver = MapSaver.MapSaver(snapshot, path, utils.map_container,
+                                        saved_cb)
+        self._saver.start()
+
     def __main_area_focus_cb(self, arg, event, extended=False):
         # Don't steal focus from textview
         # self._main_area.grab_focus()
@@ -1018,14 +1054,17 @@ class LabyrinthActivity(activity.Activity):
     def read_file(self, file_path):
         tar = Tarball(file_path)
 
-        doc = dom.parseString(tar.read(tar.getnames()[0]))
-        top_element = doc.documentElement
-
-        self.set_title(top_element.getAttribute("title"))
-        self._mode = int(top_element.getAttribute("mode"))
+        def start_cb(top_element):
+            self.set_title(top_element.getAttribute("title"))
+            self._mode = int(top_element.getAttribute("mode"))
+            self._main_area.set_mode(self._mode)
 
-        self._main_area.set_mode(self._mode)
-        self._main_area.load_thyself(top_element, doc, tar)
+        if tar.exists('MANIFEST'):
+            manifest = tar.open('MANIFEST')
+        else:
+            manifest = tar.open(tar.getnames()[0])
+        top_element = self._main_area.load_stream(manifest, tar, start_cb)
+        manifest.close()
 
         if top_element.hasAttribute("scale_factor"):
             fac = float(top_element.getAttribute("scale_factor"))
@@ -1037,29 +1076,47 @@ class LabyrinthActivity(activity.Activity):
             self._main_area.translation = [x, y]
 
         tar.close()
+        self._saved_snapshot = self._main_area.snapshot(
+            self.get_manifest_attributes())
+        self._autosave_path = None
+
+    def __wait_for_saver(self, saver):
+        # The UI keeps going while the map is written, so this can be
+        # entered again (by another write_file) before it returns
+        while not saver.wait(0.05):
+            while Gtk.events_pending():
+                Gtk.main_iteration()
+        if self._saver is saver:
+            self._saver = None
 
     def write_file(self, file_path):
-        tar = Tarball(file_path, 'w')
-
-        self._main_area.update_save()
-        manifest = self.serialize_to_xml(self._main_area.save,
-                self._main_area.element)
-        tar.write('MANIFEST', manifest)
-        self._main_area.save_thyself(tar)
-
-        tar.close()
+        # One save at a time: a save still writing is finished first
+        while self._saver is not None:
+            self.__wait_for_saver(self._saver)
+
+        snapshot = self._main_area.snapshot(self.get_manifest_attributes())
+        if self._autosave_path is not None and \
+                snapshot == self._saved_snapshot and \
+                os.path.exists(self._autosave_path):
+            shutil.copyfile(self._autosave_path, file_path)
+            return
 
-    def serialize_to_xml(self, doc, top_element):
-        top_element.setAttribute("title", self.props.title)
-        top_element.setAttribute("mode", str(self._mode))
-        top_element.setAttribute("size", str((400, 400)))
-        top_element.setAttribute("position", str((0, 0)))
-        top_element.setAttribute("maximised", str(True))
-        top_element.setAttribute("view_type", str(0))
-        top_element.setAttribute("pane_position", str(500))
-        top_element.setAttribute("scale_factor",
-                                 str(self._main_area.scale_fac))
-        top_element.setAttribute("translation",
-                                 str(self._main_area.translation))
-        string = doc.toxml()
-        return string.encode("utf-8")
+        saver = MapSaver.MapSaver(snapshot, file_path, utils.map_container)
+        self._saver = saver
+        saver.start()
+        # Sugar takes the file as soon as we return
+        self.__wait_for_saver(saver)
+        saver.raise_error()
+        self._saved_snapshot = snapshot
+        self._autosave_path = None
+
+    def get_manifest_attributes(self):
+        return {"title": self.props.title,
+                "mode": str(self._mode),
+                "size": str((400, 400)),
+                "position": str((0, 0)),
+                "maximised": str(True),
+                "view_type": str(0),
+                "pane_position": str(500),
+                "scale_factor": str(self._main_area.scale_fac),
+                "translation": str(self._main_area.translation)}
@@ -19,8 +19,8 @@ import time
 import tarfile
 import cStringIO
 import zipfile
-import tempfile
-import shutil
+import struct
+import mmap
 
 from gi.repository import Gtk
 from gi.repository import GdkPixbuf
@@ -34,17 +34,130 @@ class BadDataTypeError(TarballError):
     """Exception for unsupported data type in read/write methods."""
     pass
 
+TAR = 'tar'
+ZIP = 'zip'
+
+# Members starting with one of these are compressed already
+_COMPRESSED = ('\x89PNG\r\n\x1a\n', '\xff\xd8\xff', 'GIF8')
+
+# Fixed part of the local header of a zip member
+_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+class _TarBackend:
+    """Members of a tar file."""
+
+    def __init__(self, name, mode):
+        self.__tar = tarfile.TarFile(name=name, mode=mode)
+
+    def getnames(self):
+        return self.__tar.getnames()
+
+    def open(self, arcname):
+        return self.__tar.extractfile(arcname)
+
+    def read(self, arcname):
+        file_o = self.open(arcname)
+        if not file_o:
+            return None
+
+        out = file_o.read()
+        file_o.close()
+        return out
+
+    def add(self, info, fileobj):
+        self.__tar.addfile(info, fileobj)
+
+    def close(self):
+        self.__tar.close()
+
+
+class _ZipBackend:
+    """
+    Members of a zip file. The central directory gives random access to
+    every member; members stored without compression (images) are read
+    straight from a memory map of the file.
+    """
+
+    def __init__(self, name, mode='r'):
+        self.__zip = zipfile.ZipFile(name, mode[0], allowZip64=True)
+        self.__map = None
+        self.__file = None
+        if mode.startswith('r'):
+            try:
+                self.__file = open(name, 'rb')
+                self.__map = mmap.mmap(self.__file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            except (TypeError, EnvironmentError, ValueError):
+                self.__map = None
+                if self.__file is not None:
+                    self.__file.close()
+                    self.__file = None
+
+    def getnames(self):
+        # names flagged as utf8 in the zip are unicode
+        return [isinstance(i.filename, unicode) and
+                i.filename.encode('utf8') or i.filename
+                for i in self.__zip.infolist()
+                if not i.filename.endswith('/')]
+
+    def __getinfo(self, arcname):
+        try:
+            return self.__zip.getinfo(arcname)
+        except KeyError:
+            pass
+        return self.__zip.getinfo(arcname.decode('utf8'))
+
+    def open(self, arcname):
+        return self.__zip.open(self.__getinfo(arcname))
+
+    def read(self, arcname):
+        info = self.__getinfo(arcname)
+        if self.__map is None or info.compress_type != zipfile.ZIP_STORED \
+                or info.flag_bits & 0x1:
+            return self.__zip.read(info)
+
+        header = self.__map[info.header_offset:
+                            info.header_offset + _LOCAL_HEADER.size]
+        fields = _LOCAL_HEADER.unpack(header)
+        start = info.header_offset + _LOCAL_HEADER.size + \
+                fields[-2] + fields[-1]
+        return self.__map[start:start + info.file_size]
+
+    def add(self, info, fileobj):
+        data = fileobj.read()
+        zinfo = zipfile.ZipInfo(info.name.decode('utf8'),
+                                time.localtime(info.mtime)[:6])
+        zinfo.external_attr = info.mode << 16
+        if data.startswith(_COMPRESSED):
+            zinfo.compress_type = zipfile.ZIP_STORED
+        else:
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+        self.__zip.writestr(zinfo, data)
+
+    def close(self):
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+        self.__zip.close()
+
+
 class Tarball:
     """
     Wrap standart tarfile module to simplify read/write operations with
     most popular data types.
 
-    In read mode Tarball can load zip files as well.
+    In read mode Tarball can load zip files as well. Passing
+    format=ZIP in write mode makes a zip file instead of a tar, with
+    everything but images compressed.
 
     Supprted types:
 
         * string
         * GdkPixbuf.Pixbuf
+        * file object
 
     Write usage:
 
@@ -74,34 +187,23 @@ class Tarball:
         pixbuf_content = tar.read_pixbuf('name within tarball')
     """
 
-    def __init__(self, name=None, mode='r', mtime=None):
-        if not mode.startswith('r') or tarfile.is_tarfile(name):
-            self.__tar = tarfile.TarFile(name=name, mode=mode)
-
-        else:
-            # convert for tar
-
-            if not zipfile.is_zipfile(name):
-                raise tarfile.ReadError()
-
-            try:
-                tmp_dir = tempfile.mkdtemp()
-                tmp_fd, tmp_name = tempfile.mkstemp()
-                tmp_fo = os.fdopen(tmp_fd, 'w')
+    def __init__(self, name=None, mode='r', mtime=None, format=TAR):
+        if not mode.startswith('r'):
+            if format == ZIP:
+                self.__backend = _ZipBackend(name, mode)
+            else:
+                self.__backend = _TarBackend(name, mode)
 
-                zip = zipfile.ZipFile(name)
-                zip.extractall(tmp_dir)
+        elif tarfile.is_tarfile(name):
+            self.__backend = _TarBackend(name, mode)
 
-                tar = tarfile.TarFile(fileobj=tmp_fo, mode='w')
-                tar.add(tmp_dir, arcname='')
-                tar.close()
+        elif zipfile.is_zipfile(name):
+            self.__backend = _ZipBackend(name)
 
-                self.__tar = tarfile.TarFile(name=tmp_name, mode=mode)
+        else:
+            raise tarfile.ReadError()
 
-            finally:
-                tmp_fo.close()
-                os.unlink(tmp_name)
-                shutil.rmtree(tmp_dir)
+        self.__names = None
 
         if mtime:
             self.mtime = mtime
@@ -111,21 +213,25 @@ class Tarball:
 
     def close(self):
         """Save(if 'r' mode was given) and close tarball file."""
-        self.__tar.close()
+        self.__backend.close()
 
     def getnames(self):
         """Return names of members sorted by creation order."""
-        return self.__tar.getnames()
+        return self.__backend.getnames()
+
+    def exists(self, arcname):
+        """Tells whether tarball has a file with given name."""
+        if self.__names is None:
+            self.__names = set(self.__backend.getnames())
+        return arcname.encode('utf8') in self.__names
 
     def read(self, arcname):
         """Returns sring with content of given file from tarball."""
-        file_o = self.__tar.extractfile(arcname.encode('utf8'))
-        if not file_o:
-            return None
+        return self.__backend.read(arcname.encode('utf8'))
 
-        out = file_o.read()
-        file_o.close()
-        return out
+    def open(self, arcname):
+        """Returns file object to read given file from tarball."""
+        return self.__backend.open(arcname.encode('utf8'))
 
     def read_pixbuf(self, arcname):
         """Returns pixbuf object of given file from tarball."""
@@ -149,13 +255,25 @@ class Tarball:
         elif isinstance(data, GdkPixbuf.Pixbuf):
             self.__write_pixbuf(info, data)
 
+        elif hasattr(data, 'read'):
+            self.__write_file(info, data)
+
         else:
             raise BadDataTypeError()
 
+        if self.__names is not None:
+            self.__names.add(info.name)
+
     def __write_str(self, info, data):
         info.size = len(data)
-        self.__tar.addfile(info, cStringIO.StringIO(data))
+        self.__backend.add(info, cStringIO.StringIO(data))
         
+    def __write_file(self, info, data):
+        data.seek(0, os.SEEK_END)
+        info.size = data.tell()
+        data.seek(0)
+        self.__backend.add(info, data)
+
     def __write_pixbuf(self, info, data):
         def push(pixbuf, buffer):
             buffer.write(pixbuf)
@@ -165,4 +283,4 @@ class Tarball:
 
         info.size = buffer.tell()
         buffer.seek(0)
-        self.__tar.addfile(info, buffer)
+        self.__backend.add(info, buffer)
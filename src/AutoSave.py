@@ -0,0 +1,94 @@
+# AutoSave.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+import time
+
+from gi.repository import GObject
+
+import utils
+
+class AutoSave (object):
+    ''' Saves a map once it has been left alone for delay seconds after \
+        a change.  More changes push the save back, but never further \
+        than max_delay seconds after the first unsaved one.  Nothing is \
+        saved while the map doesn't change.  save_cb (done_cb) has to \
+        start a save and call done_cb () when it's over; changes made \
+        meanwhile get a save of their own afterwards'''
+
+    def __init__ (self, save_cb, delay = None, max_delay = None):
+        if delay is None:
+            delay = utils.autosave_delay
+        if max_delay is None:
+            max_delay = utils.autosave_max_delay
+        self.save_cb = save_cb
+        self.delay = delay
+        self.max_delay = max_delay
+        self.first_change = None
+        self.last_change = None
+        self.timeout = None
+        self.saving = False
+        self.cancelled = False
+
+    def changed (self, *args):
+        if self.cancelled or self.delay <= 0:
+            return
+        self.last_change = time.time ()
+        if self.first_change is None:
+            self.first_change = self.last_change
+        # The timeout isn't moved on every change (every key typed),
+        # it checks when it fires whether it came too early
+        if self.timeout is None and not self.saving:
+            self.schedule (self.delay)
+
+    def schedule (self, wait):
+        self.timeout = GObject.timeout_add (max (1, int (wait * 1000)),
+                                            self.timeout_cb)
+
+    def timeout_cb (self):
+        self.timeout = None
+        now = time.time ()
+        wait = min (self.last_change + self.delay,
+                    self.first_change + self.max_delay) - now
+        if wait > 0:
+            self.schedule (wait)
+        else:
+            self.save ()
+        return False
+
+    def save (self):
+        ''' Save right away if there is anything to save '''
+        if self.timeout is not None:
+            GObject.source_remove (self.timeout)
+            self.timeout = None
+        if self.first_change is None or self.saving:
+            return
+        self.first_change = None
+        self.saving = True
+        self.save_cb (self.save_done_cb)
+
+    def save_done_cb (self):
+        self.saving = False
+        if self.first_change is not None and not self.cancelled:
+            self.schedule (self.delay)
+
+    def cancel (self):
+        self.cancelled = True
+        if self.timeout is not None:
+            GObject.source_remove (self.timeout)
+            self.timeout = None
@@ -67,6 +67,9 @@ class BaseThought (GObject.GObject):
                          update_links            = (GObject.SIGNAL_RUN_LAST,
                                                     GObject.TYPE_NONE,
                                                     ()),
+                         changed                 = (GObject.SIGNAL_RUN_LAST,
+                                                    GObject.TYPE_NONE,
+                                                    ()),
                          grab_focus                = (GObject.SIGNAL_RUN_FIRST,
                                                     GObject.TYPE_NONE,
                                                     (GObject.TYPE_BOOLEAN,)),
@@ -77,9 +80,8 @@ class BaseThought (GObject.GObject):
     # The first thing that should be called is this constructor
     # It sets some basic properties of all thoughts and should be called
     # before you start doing you're own thing with thoughts
-    # save: the save document passed into the derived constructor
     # elem_type: a string representing the thought type (e.g. "image_thought")
-    def __init__ (self, save, elem_type, undo, background_color, foreground_color):
+    def __init__ (self, elem_type, undo, background_color, foreground_color):
         # Note: Once the thought has been successfully initialised (i.e. at the end
         # of the constructor) you MUST set all_okay to True
         # Otherwise, bad things will happen.
@@ -91,6 +93,9 @@ class BaseThought (GObject.GObject):
         self.sensitive = 5
         self.editing = False
         self.identity = -1
+        self.version = 0
+        self.changes = 0
+        self.save_cache = None
         self.index = 0
         self.end_index = 0
         self.text = ""
@@ -98,20 +103,18 @@ class BaseThought (GObject.GObject):
         self.background_color = background_color
         self.foreground_color = foreground_color
         self.model_iter = None
-        extended_elem = save.createElement ("Extended")
-        self.extended_buffer = TextBufferMarkup.ExtendedBuffer (self.undo, extended_elem, save)
+        self.extended_buffer = TextBufferMarkup.ExtendedBuffer (self.undo)
         self.extended_buffer.set_text("")
         self.extended_buffer.connect ("set_focus", self.focus_buffer)
         self.extended_buffer.connect ("set_attrs", self.set_extended_attrs)
-        self.element = save.createElement (elem_type)
-        self.element.appendChild (extended_elem)
+        self.extended_buffer.connect ("changed", self.extended_changed_cb)
+        self.extended_buffer.connect ("apply-tag", self.extended_changed_cb)
+        self.extended_buffer.connect ("remove-tag", self.extended_changed_cb)
+        self.element_name = elem_type
         self.creating = True
 
     # These are self-explanitory.  You probably don't want to
     # overwrite these methods, unless you have a very good reason
-    def get_save_element (self):
-        return self.element
-
     def make_primary (self):
         self.am_primary = True
 
@@ -129,6 +132,40 @@ class BaseThought (GObject.GObject):
     def okay (self):
         return self.all_okay
 
+    def update_version (self):
+        ''' Call whenever the way the thought looks changes while nothing \
+            that is saved does (mark_changed covers those).  Moving or \
+            resizing it doesn't count '''
+        self.version += 1
+
+    def mark_changed (self, looks = True):
+        ''' Call whenever something that is saved changes, other than \
+            what get_save_attributes returns (those are always compared). \
+            looks is False if the thought still looks the same and only \
+            its content moved along with it'''
+        self.changes += 1
+        if looks:
+            self.version += 1
+        self.emit ("changed")
+
+    def extended_changed_cb (self, buf, *args):
+        self.mark_changed ()
+
+    def get_save_key (self, attrs = None):
+        if attrs is None:
+            attrs = self.get_save_attributes ()
+        return (self.changes, sorted (attrs.iteritems ()),
+                self.extended_buffer.get_mark_offset ())
+
+    def get_save_fragment (self):
+        ''' The thought serialized as utf-8 xml.  It is kept between \
+            saves and only written again once something in it changed'''
+        attrs = self.get_save_attributes ()
+        key = self.get_save_key (attrs)
+        if self.save_cache is None or self.save_cache[0] != key:
+            self.save_cache = (key, utils.xml_fragment (self.serialize, attrs))
+        return self.save_cache[1]
+
     def move_content_by (self, x, y):
         pass
 
@@ -191,11 +228,38 @@ class BaseThought (GObject.GObject):
     def load (self, node, tar):
         pass
 
-    def update_save (self):
+    # The attributes of the thought's save element, as a dict of strings.
+    # serialize and the save cache work from this, so extend it rather
+    # than setting attributes by hand
+    def get_save_attributes (self):
+        attrs = {"ul-coords": str(self.ul),
+                 "lr-coords": str(self.lr),
+                 "identity": str(self.identity)}
+        if self.am_selected:
+            attrs["current_root"] = "true"
+        if self.am_primary:
+            attrs["primary_root"] = "true"
+        return attrs
+
+    # Writes the thought to writer (a sax ContentHandler) as an element
+    # of the MANIFEST.  Thoughts with more than the extended text to save
+    # should override serialize_content
+    def serialize (self, writer, attrs = None):
+        if attrs is None:
+            attrs = self.get_save_attributes ()
+        writer.startElement (self.element_name, utils.sax_attributes (attrs))
+        if self.extended_buffer.get_text ():
+            self.extended_buffer.serialize (writer)
+        self.serialize_content (writer)
+        writer.endElement (self.element_name)
+
+    def serialize_content (self, writer):
         pass
 
-    def save (self, tar):
-        pass
+    def get_save_members (self):
+        ''' (name, data) of the files that go into the map next to \
+            the MANIFEST, see MapSaver.MapSnapshot '''
+        return []
 
     def copy_text (self, clip):
         pass
@@ -267,8 +331,8 @@ class ResizableThought (BaseThought):
 
     # Possible types of resizing - where the user selected to resize
 
-    def __init__ (self, coords, save, elem_type, undo, background_color, foreground_color):
-        super (ResizableThought, self).__init__(save, elem_type, undo, background_color, foreground_color)
+    def __init__ (self, coords, elem_type, undo, background_color, foreground_color):
+        super (ResizableThought, self).__init__(elem_type, undo, background_color, foreground_color)
         self.resizing = RESIZE_NONE
         self.button_down = False
         self.orig_size = None
@@ -430,7 +494,6 @@ class ResizableThought (BaseThought):
         self.ul = action.args[choose][0]
         self.width = action.args[choose][1]
         self.height = action.args[choose][2]
-        self.pic = self.orig_pic.scale_simple (int(self.width), int(self.height), GdkPixbuf.InterpType.HYPER)
         self.recalc_edges ()
         self.emit ("update_links")
         self.emit ("update_view")
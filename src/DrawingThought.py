@@ -19,17 +19,23 @@
 # Boston, MA  02110-1301  USA
 #
 
-import xml.dom.minidom as dom
-import xml.dom
 import gettext
 _ = gettext.gettext
+import sys
 import math
+import base64
 import logging
 import cairo
+from array import array
 
 from gi.repository import Gtk
 from gi.repository import Gdk
 
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 from BaseThought import *
 import utils
 import UndoManager
@@ -39,49 +45,315 @@ STYLE_END=1
 STYLE_BEGIN=2
 ndraw =0
 SMOOTH = 5
+ERASE_RADIUS = 4
+# Version of the packed points in <stroke> elements.  Older maps keep a
+# <point> element per point, those are still read
+STROKE_FORMAT = "1"
+
+class Stroke (object):
+	''' One continuous line of a drawing.  Its points are kept as x, y \
+		pairs in a flat array of doubles, with one colour for the whole \
+		line'''
+	def __init__ (self, color = None, coords = ()):
+		if color is None:
+			color = Gdk.Color(0,0,0)
+		self.color = color
+		self.coords = array ('d', coords)
+		self.bounds = None
+		self.path = None
+
+	def __len__ (self):
+		return len (self.coords) // 2
+
+	def __iter__ (self):
+		c = self.coords
+		for i in xrange (0, len (c), 2):
+			yield c[i], c[i+1]
+
+	def append (self, x, y):
+		self.coords.append (x)
+		self.coords.append (y)
+		self.bounds = None
+		self.path = None
+
+	def move_by (self, x, y):
+		c = self.coords
+		for i in xrange (0, len (c), 2):
+			c[i] += x
+			c[i+1] += y
+		if self.bounds:
+			b = self.bounds
+			self.bounds = (b[0]+x, b[1]+y, b[2]+x, b[3]+y)
+		self.path = None
+
+	def get_bounds (self):
+		if self.bounds is None and self.coords:
+			xs = self.coords[0::2]
+			ys = self.coords[1::2]
+			self.bounds = (min (xs), min (ys), max (xs), max (ys))
+		return self.bounds
+
+	def simplify (self, tolerance):
+		''' Drop the points that are less than tolerance away from the \
+			line through the points kept around them (Ramer-Douglas-Peucker) '''
+		n = len (self)
+		if tolerance <= 0 or n < 3:
+			return False
+		c = self.coords
+		tsqr = tolerance**2
+		keep = [False] * n
+		keep[0] = keep[-1] = True
+		todo = [(0, n - 1)]
+		while todo:
+			first, last = todo.pop ()
+			ax, ay = c[2*first], c[2*first+1]
+			dx = c[2*last] - ax
+			dy = c[2*last+1] - ay
+			lsqr = dx*dx + dy*dy
+			worst = -1
+			worst_d = tsqr
+			for i in xrange (first + 1, last):
+				px = c[2*i] - ax
+				py = c[2*i+1] - ay
+				# Distance to the segment, not the whole line, so lines
+				# doubling back on themselves keep their turning points
+				t = 0.
+				if lsqr > 0:
+					t = min (1., max (0., (px*dx + py*dy) / lsqr))
+				ex = px - t*dx
+				ey = py - t*dy
+				d = ex*ex + ey*ey
+				if d > worst_d:
+					worst = i
+					worst_d = d
+			if worst >= 0:
+				keep[worst] = True
+				todo.append ((first, worst))
+				todo.append ((worst, last))
+		if all (keep):
+			return False
+		coords = array ('d')
+		for i in xrange (n):
+			if keep[i]:
+				coords.append (c[2*i])
+				coords.append (c[2*i+1])
+		self.coords = coords
+		self.bounds = None
+		self.path = None
+		return True
+
+	def add_to_path (self, context, move_x = 0, move_y = 0):
+		c = self.coords
+		if not c:
+			return
+		context.move_to (c[0]+move_x, c[1]+move_y)
+		for i in xrange (2, len (c), 2):
+			context.line_to (c[i]+move_x, c[i+1]+move_y)
+
+	def cache_path (self, context):
+		''' Keep a copy of the line as a cairo path, so drawing it again \
+			is a single append_path.  The path is made in map coordinates \
+			so it stays exact whatever the zoom it is made at'''
+		context.save ()
+		context.identity_matrix ()
+		context.new_path ()
+		self.add_to_path (context)
+		self.path = context.copy_path ()
+		context.new_path ()
+		context.restore ()
+
+	def encode (self):
+		''' The points as base64 of little endian floats '''
+		data = array ('f', self.coords)
+		if sys.byteorder == 'big':
+			data.byteswap ()
+		return base64.b64encode (data.tostring ())
+
+	@classmethod
+	def decode (cls, color, text):
+		data = array ('f')
+		data.fromstring (base64.b64decode (text))
+		if sys.byteorder == 'big':
+			data.byteswap ()
+		return cls (color, data)
+
+	def erase (self, cx, cy):
+		''' Rub out the parts of the line within ERASE_RADIUS of (cx, cy). \
+			Returns None if nothing was hit, otherwise the list of lines \
+			that are left over '''
+		r = ERASE_RADIUS
+		b = self.get_bounds ()
+		if b is None or cx < b[0] - r or cx > b[2] + r or cy < b[1] - r or cy > b[3] + r:
+			return None
+		span = self.erase_span (cx, cy)
+		if span is None:
+			return None
+		lo, hi = span
+		c = self.coords
+		sub = c[2*lo:2*hi+2]
+		pieces = self.erase_points (zip (sub[0::2], sub[1::2]), cx, cy)
+		if pieces is None:
+			return None
+		pieces = [array ('d', p) for p in pieces]
+		# Only the span was looked at, the points around it are kept as
+		# they are.  The span starts and ends with points the eraser
+		# didn't touch, so they carry on the first and last piece
+		if lo > 0:
+			pieces[0] = c[:2*lo] + pieces[0]
+		if hi < len (self) - 1:
+			pieces[-1] = pieces[-1] + c[2*hi+2:]
+		return [Stroke (self.color, p) for p in pieces]
+
+	def erase_span (self, cx, cy):
+		''' The first and last point the eraser at (cx, cy) might change, \
+			widened by one on each side.  None if it can't touch the line. \
+			Without numpy this is the whole line'''
+		n = len (self)
+		if numpy is None or n < 2:
+			return 0, n - 1
+		c = numpy.frombuffer (self.coords, dtype = numpy.float64)
+		x = c[0::2] - cx
+		y = c[1::2] - cy
+		# A pixel of slack keeps rounding on the safe side, the exact
+		# test is done on the span afterwards
+		r = ERASE_RADIUS + 1.
+		rsqr = r**2
+		hit = x * x + y * y < rsqr
+		x0 = x[:-1]
+		y0 = y[:-1]
+		x1 = x[1:]
+		y1 = y[1:]
+		dx = x1 - x0
+		dy = y1 - y0
+		cross = x0 * y1 - x1 * y0
+		seg = ((dx * dx + dy * dy) * rsqr - cross * cross > 0) & \
+			  (numpy.minimum (x0, x1) < r) & (numpy.maximum (x0, x1) > -r) & \
+			  (numpy.minimum (y0, y1) < r) & (numpy.maximum (y0, y1) > -r)
+		hit[:-1] |= seg
+		hit[1:] |= seg
+		found = numpy.flatnonzero (hit)
+		if len (found) == 0:
+			return None
+		return max (int (found[0]) - 1, 0), min (int (found[-1]) + 1, n - 1)
+
+	def erase_points (self, points, cx, cy):
+		n = len (points)
+		dists = [(x - cx)**2 + (y - cy)**2 for x, y in points]
+		r = ERASE_RADIUS
+		rsqr = r**2
+		pieces = []
+		cur = []
+		changed = False
+		i = 0
+		while i < n:
+			x, y = points[i]
+			if dists[i] < rsqr:
+				j = i
+				while j < n and dists[j] < rsqr:
+					j += 1
+				changed = True
+				# End the line just before the eraser and start it again after
+				if i > 0:
+					px, py = points[i-1]
+					start_dist = math.sqrt (dists[i]) - r
+					alpha = math.atan2 ((y-py), (x-px))
+					cur.extend ((start_dist * math.cos (alpha) + x, start_dist * math.sin (alpha) + y))
+				if cur:
+					pieces.append (cur)
+				cur = []
+				if j < n:
+					lx, ly = points[j-1]
+					nx, ny = points[j]
+					end_dist = math.sqrt (dists[j-1]) - r
+					alpha = math.atan2 ((ly-ny), (lx-nx))
+					cur.extend ((end_dist * math.cos(alpha) + lx, end_dist * math.sin(alpha) + ly))
+					cur.extend (points[j])
+				i = j + 1
+				continue
+			if i > 0:
+				cut = self.cut_segment (points[i-1], points[i], cx, cy)
+				if cut:
+					changed = True
+					cur.extend (cut[0])
+					pieces.append (cur)
+					cur = list (cut[1])
+			cur.extend ((x, y))
+			i += 1
+		if not changed:
+			return None
+		if cur:
+			pieces.append (cur)
+		return pieces
+
+	def cut_segment (self, out, x, cx, cy):
+		''' If the eraser at (cx, cy) falls across the segment from out \
+			to x without covering either end, returns where the segment \
+			has to end and where it starts again '''
+		x1 = x[0] - out[0]
+		y1 = x[1] - out[1]
+		d_rsqr = x1**2 + y1 **2
+		d = ((out[0]-cx)*(x[1]-cy) - (x[0]-cx)*(out[1]-cy))
+		det = (d_rsqr*ERASE_RADIUS**2) - d**2
+		if det <= 0:
+			return None
+		if y1 < 0:
+			sgn = -1
+		else:
+			sgn = 1
+		xt = (((d*y1) + sgn*x1 * math.sqrt (det)) / d_rsqr) + cx
+		xalt = (((d*y1) - sgn*x1 * math.sqrt (det)) / d_rsqr) + cx
+		yt = (((-d*x1) + abs(y1)*math.sqrt(det)) / d_rsqr) + cy
+		yalt = (((-d*x1) - abs(y1)*math.sqrt(det)) / d_rsqr) + cy
+		x1_inside = (xt > x[0] and xt < out[0]) or (xt > out[0] and xt < x[0])
+		x2_inside = (xalt > x[0] and xalt < out[0]) or (xalt > out[0] and xalt < x[0])
+		y1_inside = (yt > x[1] and yt < out[1]) or (yt > out[1] and yt < x[1])
+		y2_inside = (yalt > x[1] and yalt < out[1]) or (yalt > out[1] and yalt < x[1])
+
+		if (x1_inside and x2_inside and y1_inside and y2_inside) or \
+		   (x[1] == out[1] and x1_inside and x2_inside):
+			alt_nearer = abs (xalt - x[0]) < abs (xt - x[0])
+		elif x[0] == out[0] and y1_inside and y2_inside:
+			alt_nearer = abs (yalt - x[1]) < abs (yt - x[1])
+		else:
+			return None
+		if alt_nearer:
+			return (xt, yt), (xalt, yalt)
+		return (xalt, yalt), (xt, yt)
 
 class DrawingThought(ResizableThought):
-	class DrawingPoint (object):
-		def __init__ (self, coords, style=STYLE_CONTINUE, color = Gdk.Color(0,0,0), width = 2):
-			self.x, self.y = coords
-			self.style = style
-			if color == None:
-				color = Gdk.Color(0,0,0)
-			self.color = color
-			self.width = 1
-		def move_by (self, x, y):
-			self.x += x
-			self.y += y
-
-	def __init__ (self, coords, pango_context, thought_number, save, undo, loading, background_color, foreground_color):
+	def __init__ (self, coords, pango_context, thought_number, undo, loading, background_color, foreground_color):
 		global ndraw
-		super (DrawingThought, self).__init__(coords, save, "drawing_thought", undo, background_color, foreground_color)
+		super (DrawingThought, self).__init__(coords, "drawing_thought", undo, background_color, foreground_color)
 		ndraw+=1
 		self.identity = thought_number
-		self.points = []
+		self.strokes = []
+		self.current_stroke = None
 		self.text = _("Drawing #%d" % ndraw)
 		self.drawing = 0
 		self.all_okay = True
 		self.coords_smooth = []
 
 	def draw (self, context):
+		# The strokes that are finished are only turned into paths again
+		# after they moved or were simplified
+		for s in self.strokes:
+			if s.path is None and s is not self.current_stroke:
+				s.cache_path (context)
+
 		ResizableThought.draw(self, context)
 
 		cwidth = context.get_line_width ()
 		context.set_line_width (2)
 		context.set_line_join(cairo.LINE_JOIN_BEVEL)
 		context.set_line_cap(cairo.LINE_CAP_ROUND)
-		if len (self.points) > 0:
-			for p in self.points:
-				if p.style == STYLE_BEGIN:
-					context.move_to (p.x, p.y)
-					r,g,b = utils.gtk_to_cairo_color(self.foreground_color)
-					context.set_source_rgb (r, g, b)
-				elif p.style == STYLE_END:
-					context.line_to (p.x, p.y)
-					context.stroke()
+		if len (self.strokes) > 0:
+			r,g,b = utils.gtk_to_cairo_color(self.foreground_color)
+			context.set_source_rgb (r, g, b)
+			for s in self.strokes:
+				if s.path is None:
+					s.add_to_path (context)
 				else:
-					context.line_to (p.x, p.y)
+					context.append_path (s.path)
 
 		context.set_line_width (cwidth)
 		context.stroke ()
@@ -94,12 +366,12 @@ class DrawingThought(ResizableThought):
 		self.undo.block ()
 		if mode == UndoManager.UNDO:
 			choose = 1
-			for p in action.args[0]:
-				self.points.remove (p)
+			for s in action.args[0]:
+				self.strokes.remove (s)
 		else:
 			choose = 2
-			for p in action.args[0]:
-				self.points.append (p)
+			self.strokes.extend (action.args[0])
+		self.mark_changed ()
 
 		self.ul = action.args[choose][0]
 		self.width = action.args[choose][1]
@@ -119,15 +391,19 @@ class DrawingThought(ResizableThought):
 			if not event.state & Gdk.ModifierType.SHIFT_MASK:
 				self.drawing = 1
 			self.orig_size = (self.ul, self.width, self.height)
-			self.ins_points = []
-			self.del_points = []
+			self.ins_strokes = []
+			self.orig_strokes = list (self.strokes)
 			return True
 
 		return False
 
 	def process_button_release (self, event, transformed):
-		if len(self.points) > 0:
-			self.points[-1].style=STYLE_END
+		if self.current_stroke is not None:
+			# The same stroke object is in the undo record, so it stays
+			# in step with what is shown
+			if self.current_stroke.simplify (utils.stroke_tolerance):
+				self.mark_changed ()
+			self.current_stroke = None
 
 		if self.orig_size:
 			if self.drawing == 0:
@@ -144,12 +420,12 @@ class DrawingThought(ResizableThought):
 
 			elif self.drawing == 1:
 				self.undo.add_undo (UndoManager.UndoAction (self, UNDO_DRAW, \
-						self.undo_drawing, self.ins_points, self.orig_size, \
+						self.undo_drawing, self.ins_strokes, self.orig_size, \
 						(self.ul, self.width, self.height)))
 
 			elif self.drawing == 2:
 				self.undo.add_undo (UndoManager.UndoAction (self, UNDO_ERASE, \
-						self.undo_erase, self.ins_points))
+						self.undo_erase, self.orig_strokes, list (self.strokes)))
 
 		self.drawing = 0
 		return ResizableThought.process_button_release(self, event, transformed)
@@ -160,19 +436,11 @@ class DrawingThought(ResizableThought):
 
 	def undo_erase (self, action, mode):
 		self.undo.block ()
-		action.args[0].reverse ()
 		if mode == UndoManager.UNDO:
-			for x in action.args[0]:
-				if x[0] == 0:
-					self.points.remove (x[2])
-				else:
-					self.points.insert (x[1],x[2])
+			self.strokes = list (action.args[0])
 		else:
-			for x in action.args[0]:
-				if x[0] == 0:
-					self.points.insert (x[1], x[2])
-				else:
-					self.points.remove (x[2])
+			self.strokes = list (action.args[1])
+		self.mark_changed ()
 		self.undo.unblock ()
 		self.emit ("update_view")
 
@@ -212,178 +480,55 @@ class DrawingThought(ResizableThought):
 				self.max_y = coords[1]+5
 			self.width = self.lr[0] - self.ul[0]
 			self.height = self.lr[1] - self.ul[1]
-			if len(self.points) == 0 or self.points[-1].style == STYLE_END:
-				p = self.DrawingPoint (coords, STYLE_BEGIN, self.foreground_color)
-			else:
-				p = self.DrawingPoint (coords, STYLE_CONTINUE)
-			self.points.append (p)
-			self.ins_points.append (p)
+			if self.current_stroke is None:
+				self.current_stroke = Stroke (self.foreground_color)
+				self.strokes.append (self.current_stroke)
+				self.ins_strokes.append (self.current_stroke)
+			self.current_stroke.append (coords[0], coords[1])
+			self.mark_changed ()
 			return True
 
-		elif self.drawing == 2 and len (self.points) > 0:
-			out = self.points[0]
-			loc = []
-			handle = []
-			ins_point = -1
-
-			for x in self.points:
-				ins_point += 1
-				dist = (x.x - coords[0])**2 + (x.y - coords[1])**2
-
-				if dist < 16:
-					if x == self.points[0]:
-						out = None
-					loc.append ((ins_point, x, dist))
-				else:
-					if len(loc) != 0:
-						handle.append ((loc, out, x))
-						loc = []
-					elif x.style != STYLE_BEGIN:
-						x1 = x.x - out.x
-						y1 = x.y - out.y
-						d_rsqr = x1**2 + y1 **2
-						d = ((out.x-coords[0])*(x.y-coords[1]) - (x.x-coords[0])*(out.y-coords[1]))
-						det = (d_rsqr*16) - d**2
-						if det > 0:
-							xt = -99999
-							yt = -99999
-							xalt = -99999
-							yalt = -99999
-							if y1 < 0:
-								sgn = -1
-							else:
-								sgn = 1
-							xt = (((d*y1) + sgn*x1 * math.sqrt (det)) / d_rsqr) +coords[0]
-							xalt = (((d*y1) - sgn*x1 * math.sqrt (det)) / d_rsqr) +coords[0]
-							yt = (((-d*x1) + abs(y1)*math.sqrt(det)) / d_rsqr) + coords[1]
-							yalt = (((-d*x1) - abs(y1)*math.sqrt(det)) / d_rsqr) +coords[1]
-							x1_inside = (xt > x.x and xt < out.x) or (xt > out.x and xt < x.x)
-							x2_inside = (xalt > x.x and xalt < out.x) or (xalt > out.x and xalt < x.x)
-							y1_inside = (yt > x.y and yt < out.y) or (yt > out.y and yt < x.y)
-							y2_inside = (yalt > x.y and yalt < out.y) or (yalt > out.y and yalt < x.y)
-
-
-							if (x1_inside and x2_inside and y1_inside and y2_inside):
-							   	if abs (xalt - x.x) < abs (xt - x.x):
-							   		handle.append ((None, out, x, ins_point, xt, xalt, yt, yalt))
-							   	else:
-							   		handle.append ((None, out, x, ins_point, xalt, xt, yalt, yt))
-							elif x.x == out.x and y1_inside and y2_inside:
-							   	if abs (yalt - x.y) < abs (yt - x.y):
-							   		handle.append ((None, out, x, ins_point, xt, xalt, yt, yalt))
-							   	else:
-							   		handle.append ((None, out, x, ins_point, xalt, xt, yalt, yt))
-							elif x.y == out.y and x1_inside and x2_inside:
-								if abs (xalt - x.x) < abs (xt - x.x):
-								   	handle.append ((None, out, x, ins_point, xt, xalt, yt, yalt))
-								else:
-								   	handle.append ((None, out, x, ins_point, xalt, xt, yalt, yt))
-
-					out = x
-			if loc:
-				handle.append ((loc, out, None))
-			appends = []
-			dels = []
-			for l in handle:
-				inside = l[0]
-				prev = l[1]
-				next = l[2]
-				if not inside:
-					ins = l[3]
-					x1 = l[4]
-					x2 = l[5]
-					y1 = l[6]
-					y2 = l[7]
-					p1 = self.DrawingPoint ((x1,y1), STYLE_END)
-					p2 = self.DrawingPoint ((x2,y2), STYLE_BEGIN)
-					appends.append ((p1, ins))
-					appends.append ((p2, ins))
+		elif self.drawing == 2 and len (self.strokes) > 0:
+			strokes = []
+			hit = False
+			for s in self.strokes:
+				pieces = s.erase (coords[0], coords[1])
+				if pieces is None:
+					strokes.append (s)
 				else:
-					first = inside[0][1]
-					last = inside[-1][1]
-					done_ins = 0
-					if last.style != STYLE_END:
-						end_dist = math.sqrt (inside[-1][2]) - 4
-						alpha = math.atan2 ((last.y-next.y), (last.x-next.x))
-						new_x = end_dist * math.cos(alpha) + last.x
-						new_y = end_dist * math.sin(alpha) + last.y
-						p = self.DrawingPoint ((new_x, new_y), STYLE_BEGIN)
-						appends.append ((p, inside[-1][0]))
-						done_ins = 1
-					if first.style != STYLE_BEGIN:
-						start_dist = math.sqrt (inside[0][2]) - 4
-						alpha = math.atan2 ((first.y-prev.y),(first.x-prev.x))
-						new_x = start_dist * math.cos (alpha) + first.x
-						new_y = start_dist * math.sin (alpha) + first.y
-						p = self.DrawingPoint ((new_x, new_y), STYLE_END)
-						appends.append ((p, inside[0][0]-done_ins))
-					for i in inside:
-						dels.append (i[1])
-			inserts = 0
-			for x in appends:
-				self.points.insert (x[1]+inserts, x[0])
-				self.ins_points.append ((0, x[1]+inserts, x[0]))
-				inserts+=1
-			for x in dels:
-				self.ins_points.append ((1, self.points.index (x), x))
-				self.points.remove (x)
-
+					strokes.extend (pieces)
+					hit = True
+			if hit:
+				self.strokes = strokes
+				self.mark_changed ()
 			return True
 
 		return False
 
 	def move_content_by(self, x, y):
-		map(lambda p : p.move_by(x,y), self.points)
+		map(lambda s : s.move_by(x,y), self.strokes)
+		self.mark_changed (looks = False)
 		ResizableThought.move_content_by(self, x, y)
 
-	def update_save (self):
-		next = self.element.firstChild
-		while next:
-			m = next.nextSibling
-			if next.nodeName == "point":
-				self.element.removeChild (next)
-				next.unlink ()
-			next = m		
-		text = self.extended_buffer.get_text ()
-		if text:
-			self.extended_buffer.update_save()
-		else:
-			try:
-				self.element.removeChild(self.extended_buffer.element)
-			except xml.dom.NotFoundErr:
-				pass
-		self.element.setAttribute ("ul-coords", str(self.ul))
-		self.element.setAttribute ("lr-coords", str(self.lr))
-		self.element.setAttribute ("identity", str(self.identity))
-		self.element.setAttribute ("background-color", self.background_color.to_string())
-		self.element.setAttribute ("foreground-color", self.foreground_color.to_string())
-		self.element.setAttribute ("min_x", str(self.min_x))
-		self.element.setAttribute ("min_y", str(self.min_y))
-		self.element.setAttribute ("max_x", str(self.max_x))
-		self.element.setAttribute ("max_y", str(self.max_y))
-
-		if self.am_selected:
-				self.element.setAttribute ("current_root", "true")
-		else:
-			try:
-				self.element.removeAttribute ("current_root")
-			except xml.dom.NotFoundErr:
-				pass
-		if self.am_primary:
-			self.element.setAttribute ("primary_root", "true");
-		else:
-			try:
-				self.element.removeAttribute ("primary_root")
-			except xml.dom.NotFoundErr:
-				pass
-		doc = self.element.ownerDocument
-		for p in self.points:
-			elem = doc.createElement ("point")
-			self.element.appendChild (elem)
-			elem.setAttribute ("coords", str((p.x,p.y)))
-			elem.setAttribute ("type", str(p.style))
-			elem.setAttribute ("color", p.color.to_string())
-		return
+	def get_save_attributes (self):
+		attrs = ResizableThought.get_save_attributes (self)
+		attrs["background-color"] = self.background_color.to_string()
+		attrs["foreground-color"] = self.foreground_color.to_string()
+		attrs["min_x"] = str(self.min_x)
+		attrs["min_y"] = str(self.min_y)
+		attrs["max_x"] = str(self.max_x)
+		attrs["max_y"] = str(self.max_y)
+		return attrs
+
+	def stroke_attributes (self, s):
+		return {"color": s.color.to_string(),
+				"format": STROKE_FORMAT}
+
+	def serialize_content (self, writer):
+		for s in self.strokes:
+			writer.startElement ("stroke", utils.sax_attributes (self.stroke_attributes (s)))
+			writer.characters (s.encode ())
+			writer.endElement ("stroke")
 
 	def load (self, node, tar):
 		tmp = node.getAttribute ("ul-coords")
@@ -417,34 +562,51 @@ class DrawingThought(ResizableThought):
 		self.am_selected = node.hasAttribute ("current_root")
 		self.am_primary = node.hasAttribute ("primary_root")
 
+		stroke = None
 		for n in node.childNodes:
 			if n.nodeName == "Extended":
 				self.extended_buffer.load(n)
-			elif n.nodeName == "point":
-				style = int (n.getAttribute ("type"))
-				tmp = n.getAttribute ("coords")
-				c = utils.parse_coords (tmp)
+			elif n.nodeName == "stroke":
+				if n.getAttribute ("format") != STROKE_FORMAT:
+					print "Unknown stroke format: "+str(n.getAttribute ("format"))
+					continue
 				col = None
 				try:
-					tmp = n.getAttribute ("color")
-					col = Gdk.Color.parse(tmp)[1]
+					col = Gdk.Color.parse(n.getAttribute ("color"))[1]
 				except ValueError:
 					pass
-				self.points.append (self.DrawingPoint (c, style, col))
+				text = "".join ([t.data for t in n.childNodes if t.nodeType == t.TEXT_NODE])
+				self.strokes.append (Stroke.decode (col, text))
+			elif n.nodeName == "point":
+				# Old format, one element per point
+				style = int (n.getAttribute ("type"))
+				tmp = n.getAttribute ("coords")
+				c = utils.parse_coords (tmp)
+				if style == STYLE_BEGIN or stroke is None:
+					col = None
+					try:
+						tmp = n.getAttribute ("color")
+						col = Gdk.Color.parse(tmp)[1]
+					except ValueError:
+						pass
+					stroke = Stroke (col)
+					self.strokes.append (stroke)
+				stroke.append (c[0], c[1])
+				if style == STYLE_END:
+					stroke = None
 			else:
 				print "Unknown node type: "+str(n.nodeName)
+		if utils.simplify_on_load:
+			for s in self.strokes:
+				s.simplify (utils.stroke_tolerance)
 
 	def export (self, context, move_x, move_y):
 		utils.export_thought_outline (context, self.ul, self.lr, self.background_color, self.am_selected, self.am_primary, utils.STYLE_NORMAL,
 									  (move_x, move_y))
 		cwidth = context.get_line_width ()
 		context.set_line_width (1)
-		if len (self.points) > 0:
-			for p in self.points:
-				if p.style == STYLE_BEGIN:
-					context.move_to (p.x+move_x, p.y+move_y)
-				else:
-					context.line_to (p.x+move_x,p.y+move_y)
+		for s in self.strokes:
+			s.add_to_path (context, move_x, move_y)
 
 		context.set_line_width (cwidth)
 		r,g,b = utils.gtk_to_cairo_color(self.foreground_color)
@@ -0,0 +1,276 @@
+# ImageCache.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+import logging
+import hashlib
+import weakref
+import threading
+import collections
+
+from gi.repository import GdkPixbuf
+from gi.repository import GObject
+
+import utils
+
+def pixbuf_size (pixbuf):
+    return pixbuf.get_rowstride () * pixbuf.get_height ()
+
+class ImageCache (object):
+    ''' Keeps halved copies of images (a pyramid: 1/2, 1/4, 1/8 ...) so \
+        a picture can be scaled to any size starting from the smallest \
+        copy that is still at least that big, rather than from the full \
+        size original every time.  The copies are shared by everybody \
+        showing the same image and the least recently used ones are \
+        dropped once they take more than budget bytes.  The copies are \
+        found by a key naming the picture (the digest of its \
+        StoredImage), so the originals are never held by the cache'''
+
+    def __init__ (self, budget = None):
+        if budget is None:
+            budget = utils.image_cache_budget
+        self.budget = budget
+        self.used = 0
+        self.levels = collections.OrderedDict ()
+
+    def level_for (self, key, pixbuf, width, height):
+        ''' Returns the smallest copy of pixbuf, the picture named key, \
+            that is at least width x height '''
+        w = pixbuf.get_width ()
+        h = pixbuf.get_height ()
+        level = 0
+        while w >> (level + 1) >= max (width, 1) and h >> (level + 1) >= max (height, 1):
+            level += 1
+        return self.get_level (key, pixbuf, level)
+
+    def get_level (self, key, pixbuf, level):
+        if level == 0:
+            return pixbuf
+        pic = self.levels.pop ((key, level), None)
+        if pic is None:
+            # Halving the next bigger copy is much cheaper than going
+            # down from the original, and looks just as good
+            parent = self.get_level (key, pixbuf, level - 1)
+            pic = parent.scale_simple (max (1, parent.get_width () / 2),
+                                       max (1, parent.get_height () / 2),
+                                       GdkPixbuf.InterpType.BILINEAR)
+            self.used += pixbuf_size (pic)
+        self.levels[(key, level)] = pic
+        self.evict ()
+        return pic
+
+    def scale (self, key, pixbuf, width, height, interp = GdkPixbuf.InterpType.HYPER):
+        ''' Like pixbuf.scale_simple, but starting from the closest copy '''
+        width = max (1, int (width))
+        height = max (1, int (height))
+        pic = self.level_for (key, pixbuf, width, height)
+        if pic.get_width () == width and pic.get_height () == height:
+            return pic
+        return pic.scale_simple (width, height, interp)
+
+    def evict (self):
+        while self.used > self.budget and len (self.levels) > 1:
+            key, pic = self.levels.popitem (last = False)
+            self.used -= pixbuf_size (pic)
+
+    def forget (self, key):
+        for k in [k for k in self.levels if k[0] == key]:
+            self.used -= pixbuf_size (self.levels.pop (k))
+
+    def clear (self):
+        self.levels.clear ()
+        self.used = 0
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+def encode (pixbuf):
+    ''' The pixbuf as the bytes of a PNG file '''
+    ok, data = pixbuf.save_to_bufferv ('png', [], [])
+    return data
+
+def decode (data):
+    ''' Turn the bytes of an image file into a pixbuf '''
+    loader = GdkPixbuf.PixbufLoader ()
+    loader.write (data)
+    loader.close ()
+    return loader.get_pixbuf ()
+
+class StoredImage (object):
+    ''' One picture of a map: the bytes of its PNG file and, while they \
+        are needed, the decoded full size pixbuf.  All the image thoughts \
+        showing the same picture share a StoredImage, and with it the \
+        decoded original, its halved copies and the file in the map'''
+
+    def __init__ (self, digest, data, pic = None):
+        self.digest = digest
+        self.data = data
+        self.pic = pic
+        self.name = 'images/%s.png' % digest
+        self.decoding = False
+        self.failed = False
+        self.waiting = []
+
+    def get_pic (self):
+        ''' The full size picture, decoded from data if need be.  None \
+            if the data can't be decoded'''
+        if self.pic is None and not self.failed:
+            try:
+                self.pic = decode (self.data)
+            except Exception, e:
+                logging.error ("Can't decode %s: %s" % (self.name, e))
+                self.failed = True
+                return None
+        if self.pic is not None:
+            get_decoded ().touch (self, self.pic)
+        return self.pic
+
+    def drop_original (self):
+        ''' Called when memory for decoded images runs short.  The \
+            halved copies are kept, they don't need the original '''
+        self.pic = None
+
+    def decode_in_background (self, done_cb):
+        ''' Decode the picture in a thread of its own, done_cb () is \
+            called on the main loop once pic is there'''
+        if self.failed:
+            return
+        self.waiting.append (done_cb)
+        if not self.decoding:
+            self.decoding = True
+            thread = threading.Thread (target = self.decode_thread, args = (self.data,))
+            thread.daemon = True
+            thread.start ()
+
+    def decode_thread (self, data):
+        try:
+            pic = decode (data)
+        except Exception, e:
+            logging.error ("Can't decode %s: %s" % (self.name, e))
+            GObject.idle_add (self.decode_failed_cb)
+            return
+        GObject.idle_add (self.decoded_cb, pic)
+
+    def decode_failed_cb (self):
+        # Trying again would only fail again, the thoughts stay empty
+        self.decoding = False
+        self.failed = True
+        self.waiting = []
+        return False
+
+    def decoded_cb (self, pic):
+        self.decoding = False
+        if self.pic is None:
+            self.pic = pic
+            get_decoded ().touch (self, pic)
+        waiting = self.waiting
+        self.waiting = []
+        for cb in waiting:
+            cb ()
+        return False
+
+class ImageStore (object):
+    ''' Hands out one StoredImage per distinct picture of a map, found \
+        by the hash of the bytes of its PNG file (or of the file it \
+        came from).  Every map has a store of its own.  Only weak \
+        references are kept: a picture is forgotten once no thought \
+        (including deleted ones the undo list still holds on to) uses \
+        it'''
+
+    def __init__ (self):
+        self.images = weakref.WeakValueDictionary ()
+
+    def __len__ (self):
+        return len (set (self.images.values ()))
+
+    def get (self, data):
+        digest = hashlib.sha1 (data).hexdigest ()
+        image = self.images.get (digest)
+        if image is None:
+            if data.startswith (PNG_SIGNATURE):
+                image = StoredImage (digest, data)
+            else:
+                # Maps have always stored their pictures as PNG.  Other
+                # formats are converted right away, so a picture is
+                # found by the same PNG bytes before and after a save
+                pic = decode (data)
+                png = encode (pic)
+                png_digest = hashlib.sha1 (png).hexdigest ()
+                image = self.images.get (png_digest)
+                if image is None:
+                    image = StoredImage (png_digest, png, pic)
+                    self.images[png_digest] = image
+            # For other formats the original bytes lead to it as well,
+            # so the same file inserted again isn't converted again
+            self.images[digest] = image
+        return image
+
+class DecodedImages (object):
+    ''' Keeps track of the full size originals of the StoredImages that \
+        have been decoded.  Once they take more than budget bytes, the \
+        least recently used are handed back to their drop_original, to \
+        be decoded again from the file data when next needed.  The \
+        StoredImages are only weakly referenced'''
+
+    def __init__ (self, budget = None):
+        if budget is None:
+            budget = utils.image_decode_budget
+        self.budget = budget
+        self.used = 0
+        self.owners = collections.OrderedDict ()
+
+    def touch (self, owner, pixbuf):
+        key = weakref.ref (owner, self.forget_ref)
+        entry = self.owners.pop (key, None)
+        if entry is None:
+            entry = (pixbuf_size (pixbuf), owner.digest)
+            self.used += entry[0]
+        self.owners[key] = entry
+        while self.used > self.budget and len (self.owners) > 1:
+            ref, entry = self.owners.popitem (last = False)
+            self.used -= entry[0]
+            old = ref ()
+            if old is not None:
+                old.drop_original ()
+
+    def forget (self, owner):
+        self.forget_ref (weakref.ref (owner))
+
+    def forget_ref (self, ref):
+        entry = self.owners.pop (ref, None)
+        if entry:
+            self.used -= entry[0]
+            if ref () is None:
+                # Nobody shows the picture any more, so its halved
+                # copies can go as well
+                get_default ().forget (entry[1])
+
+_default = None
+_decoded = None
+
+def get_default ():
+    ''' The cache shared by all the image thoughts '''
+    global _default
+    if _default is None:
+        _default = ImageCache ()
+    return _default
+
+def get_decoded ():
+    global _decoded
+    if _decoded is None:
+        _decoded = DecodedImages ()
+    return _decoded
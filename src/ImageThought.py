@@ -19,8 +19,6 @@
 # Boston, MA  02110-1301  USA
 #
 
-import xml.dom.minidom as dom
-import xml.dom
 import gettext
 _ = gettext.gettext
 import cairo
@@ -37,17 +35,21 @@ from sugar3 import mime
 from BaseThought import *
 import utils
 import UndoManager
+import ImageCache
 
 from sugar3.activity.activity import get_activity_root
 from sugar3.graphics.objectchooser import ObjectChooser
 
 class ImageThought (ResizableThought):
-    def __init__ (self, coords, pango_context, thought_number, save, undo, loading, background_color, foreground_color):
-        super (ImageThought, self).__init__(coords, save, "image_thought", undo, background_color, foreground_color)
+    def __init__ (self, coords, pango_context, thought_number, undo, loading, background_color, foreground_color, store = None):
+        super (ImageThought, self).__init__(coords, "image_thought", undo, background_color, foreground_color)
 
         self.identity = thought_number
         self.pic = None
-        self.orig_pic = None
+        # The picture, shared with the other thoughts of the map showing
+        # the same one
+        self.store = store
+        self.image = None
         self.pic_location = coords
         self.button_press = False
         self.all_okay = True
@@ -73,8 +75,16 @@ class ImageThought (ResizableThought):
             if jobject and jobject.file_path:
                 logging.debug("journal_open_image: fname=%s" % jobject.file_path)
                 try:
-                    self.orig_pic = GdkPixbuf.Pixbuf.new_from_file(jobject.file_path)
-                    self.filename = os.path.join('images', os.path.basename(jobject.file_path))
+                    f = open (jobject.file_path, 'rb')
+                    try:
+                        data = f.read ()
+                    finally:
+                        f.close ()
+                    self.image = self.store.get (data)
+                    if self.image.get_pic () is None:
+                        return False
+                    name = os.path.join('images', os.path.basename(jobject.file_path))
+                    self.filename = self.image.name
                 except Exception, e:
                     logging.error("journal_open_image: %s" % e)
                     return False
@@ -85,14 +95,53 @@ class ImageThought (ResizableThought):
             del chooser
         self.object_chooser_active = False
 
-        self.text = self.filename[0:self.filename.rfind('.')]
+        self.text = name[0:name.rfind('.')]
         self.recalc_edges(True)
 
         return True
 
+    def get_orig_pic (self):
+        ''' The full size picture, decoded if need be '''
+        if self.image is None:
+            return None
+        return self.image.get_pic ()
+
+    def load_pic (self, background = False):
+        if not background or self.image.pic is not None:
+            self.recalc_edges (True)
+        elif self.decoded_cb not in self.image.waiting:
+            self.image.decode_in_background (self.decoded_cb)
+
+    def decoded_cb (self):
+        self.recalc_edges (True)
+        self.update_version ()
+        self.emit ("update_view")
+
     def draw (self, context):
         ResizableThought.draw(self, context)
-        if self.pic:
+        if self.pic is None and self.image is not None:
+            # Until the picture is decoded only the outline is drawn
+            self.load_pic (utils.decode_images_in_background)
+        pic = self.pic
+        if pic and self.image.pic:
+            # Zoomed out, a smaller copy of the original does as well and
+            # saves cairo from filtering the big one down on every draw
+            zoom = abs (context.user_to_device_distance (1, 0)[0])
+            if zoom < 0.5:
+                pic = ImageCache.get_default ().level_for (self.image.digest, self.image.pic,
+                        self.pic.get_width () * zoom, self.pic.get_height () * zoom)
+                if pic.get_width () >= self.pic.get_width ():
+                    pic = self.pic
+        if pic and pic is not self.pic:
+            context.save ()
+            context.translate (self.pic_location[0], self.pic_location[1])
+            context.scale (float (self.pic.get_width ()) / pic.get_width (),
+                           float (self.pic.get_height ()) / pic.get_height ())
+            context.set_source_pixbuf (pic, 0, 0)
+            context.rectangle (0, 0, pic.get_width (), pic.get_height ())
+            context.fill ()
+            context.restore ()
+        elif pic:
             context.set_source_pixbuf (self.pic, self.pic_location[0], self.pic_location[1])
             context.rectangle (self.pic_location[0], self.pic_location[1], self.width, self.height)
             context.fill ()
@@ -101,16 +150,16 @@ class ImageThought (ResizableThought):
     def export (self, context, move_x, move_y):
         utils.export_thought_outline (context, self.ul, self.lr, self.background_color, self.am_selected, self.am_primary, utils.STYLE_NORMAL,
                                       (move_x, move_y))
+        if self.pic is None and self.image is not None:
+            self.load_pic ()
         if self.pic:
-            raw_pixels = self.pic.get_pixels_array()
             if hasattr(context, "set_source_pixbuf"):
                 context.set_source_pixbuf (self.pic, self.pic_location[0]+move_x, self.pic_location[1]+move_y)
             elif hasattr(context, "set_source_surface"):
-                pixel_array = utils.pixbuf_to_cairo (raw_pixels)
-                image_surface = cairo.ImageSurface.create_for_data(pixel_array, cairo.FORMAT_ARGB32, len(raw_pixels[0]), len(raw_pixels), -1)
+                image_surface = utils.pixbuf_to_surface (self.pic)
                 context.set_source_surface (image_surface, self.pic_location[0]+move_x, self.pic_location[1]+move_y)
-                
-            context.rectangle (self.pic_location[0]+move_x, self.pic_location[1]+move_y, len(raw_pixels[0]), len(raw_pixels))
+
+            context.rectangle (self.pic_location[0]+move_x, self.pic_location[1]+move_y, self.pic.get_width(), self.pic.get_height())
             context.fill ()
         context.set_source_rgb (0,0,0)
 
@@ -123,10 +172,16 @@ class ImageThought (ResizableThought):
         pic_w = max(MIN_SIZE, self.width - margin[0] - margin[2])
         pic_h = max(MIN_SIZE, self.height - margin[1] - margin[3])
 
-        if self.orig_pic and (force or not self.pic or self.pic.get_width() != pic_w
-                or self.pic.get_height() != pic_h):
-                        self.pic = self.orig_pic.scale_simple(int(pic_w),
-                                  int(pic_h), scale)
+        if not force and self.pic is None and \
+                (self.image is None or self.image.pic is None):
+            # Not decoded yet, that happens once it is drawn
+            return
+        if force or not self.pic or self.pic.get_width() != pic_w \
+                or self.pic.get_height() != pic_h:
+            orig_pic = self.get_orig_pic ()
+            if orig_pic:
+                self.pic = ImageCache.get_default ().scale (self.image.digest, orig_pic,
+                                  pic_w, pic_h, scale)
 
 
     def process_button_down (self, event, coords):
@@ -144,8 +199,8 @@ class ImageThought (ResizableThought):
                     self.width = max(MIN_SIZE, self.width)
                     self.height = max(MIN_SIZE, self.height)
                 else:
-                    self.width = self.orig_pic.get_width()
-                    self.height = self.orig_pic.get_height()
+                    self.width = self.get_orig_pic().get_width()
+                    self.height = self.get_orig_pic().get_height()
                 self.creating = False
             else:
                 self.undo.add_undo (UndoManager.UndoAction (self, UNDO_RESIZE, \
@@ -164,40 +219,18 @@ class ImageThought (ResizableThought):
 
         return False
 
-    def update_save (self):
-        text = self.extended_buffer.get_text ()
-        if text:
-            self.extended_buffer.update_save()
-        else:
-            try:
-                self.element.removeChild(self.extended_buffer.element)
-            except xml.dom.NotFoundErr:
-                pass
-        self.element.setAttribute ("ul-coords", str(self.ul))
-        self.element.setAttribute ("lr-coords", str(self.lr))
-        self.element.setAttribute ("identity", str(self.identity))
-        self.element.setAttribute ("background-color", self.background_color.to_string())
-        self.element.setAttribute ("file", str(self.filename))
-        self.element.setAttribute ("image_width", str(self.width))
-        self.element.setAttribute ("image_height", str(self.height))
-        if self.am_selected:
-                self.element.setAttribute ("current_root", "true")
-        else:
-            try:
-                self.element.removeAttribute ("current_root")
-            except xml.dom.NotFoundErr:
-                pass
-        if self.am_primary:
-            self.element.setAttribute ("primary_root", "true")
-        else:
-            try:
-                self.element.removeAttribute ("primary_root")
-            except xml.dom.NotFoundErr:
-                pass
+    def get_save_attributes (self):
+        attrs = super (ImageThought, self).get_save_attributes ()
+        attrs["background-color"] = self.background_color.to_string()
+        attrs["file"] = str(self.filename)
+        attrs["image_width"] = str(self.width)
+        attrs["image_height"] = str(self.height)
+        return attrs
 
-    def save (self, tar):
-        if not [i for i in tar.getnames() if i == self.filename]:
-            tar.write(self.filename, self.orig_pic)
+    def get_save_members (self):
+        if self.image is None:
+            return []
+        return [(self.filename, self.image.data)]
 
     def load (self, node, tar):
         tmp = node.getAttribute ("ul-coords")
@@ -226,7 +259,10 @@ class ImageThought (ResizableThought):
                 print "Unknown: "+n.nodeName
         margin = utils.margin_required (utils.STYLE_NORMAL)
         self.pic_location = (self.ul[0]+margin[0], self.ul[1]+margin[1])
-        self.orig_pic = tar.read_pixbuf(self.filename)
+        # Old maps may hold the same picture under several names, from
+        # now on it is saved once
+        self.image = self.store.get (tar.read(self.filename))
+        self.filename = self.image.name
         self.lr = (self.pic_location[0]+self.width+margin[2], self.pic_location[1]+self.height+margin[3])
         self.recalc_edges()
     
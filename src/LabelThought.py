@@ -22,7 +22,6 @@
 #
 
 import utils
-import xml.dom
 
 from gi.repository import Gtk
 from gi.repository import Gdk
@@ -32,8 +31,8 @@ from BaseThought import *
 from TextThought import TextThought
 
 class LabelThought (TextThought):
-    def __init__ (self, coords, pango_context, thought_number, save, undo, loading, background_color, foreground_color, name="label_thought"):
-        super (LabelThought, self).__init__(coords, pango_context, thought_number, save, undo, loading, background_color, foreground_color, name)
+    def __init__ (self, coords, pango_context, thought_number, undo, loading, background_color, foreground_color, name="label_thought"):
+        super (LabelThought, self).__init__(coords, pango_context, thought_number, undo, loading, background_color, foreground_color, name)
         self.edge = True
 
     def can_be_parent(self):
@@ -53,7 +52,6 @@ class LabelThought (TextThought):
         else:
             r, g ,b = utils.gtk_to_cairo_color(utils.default_colors["text"])
         context.set_source_rgb (r, g, b)
-        self.layout.set_alignment(Pango.Alignment.CENTER)
         context.move_to (textx, texty)
         context.show_layout (self.layout)
         if self.editing:
@@ -72,78 +70,10 @@ class LabelThought (TextThought):
         context.set_source_rgb (0,0,0)
         context.stroke ()
 
-    def update_save (self):
-        next = self.element.firstChild
-        while next:
-            m = next.nextSibling
-            if next.nodeName == "attribute":
-                self.element.removeChild (next)
-                next.unlink ()
-            next = m
-
-        if self.text_element.parentNode is not None:
-            self.text_element.replaceWholeText (self.text)
-        text = self.extended_buffer.get_text ()
-        if text:
-            self.extended_buffer.update_save()
-        else:
-            try:
-                self.element.removeChild(self.extended_buffer.element)
-            except xml.dom.NotFoundErr:
-                pass
-        self.element.setAttribute ("cursor", str(self.index))
-        self.element.setAttribute ("ul-coords", str(self.ul))
-        self.element.setAttribute ("lr-coords", str(self.lr))
-        self.element.setAttribute ("identity", str(self.identity))
-        self.element.setAttribute ("background-color", utils.color_to_string(self.background_color))
-        self.element.setAttribute ("foreground-color", utils.color_to_string(self.foreground_color))
-        self.element.setAttribute ("edge", str(self.edge))
-        if self.am_selected:
-                self.element.setAttribute ("current_root", "true")
-        else:
-            try:
-                self.element.removeAttribute ("current_root")
-            except xml.dom.NotFoundErr:
-                pass
-        if self.am_primary:
-            self.element.setAttribute ("primary_root", "true");
-        else:
-            try:
-                self.element.removeAttribute ("primary_root")
-            except xml.dom.NotFoundErr:
-                pass
-        doc = self.element.ownerDocument
-        it = self.attributes.get_iterator()
-        while (1):
-            r = it.range()
-            for x in it.get_attrs():
-                if x.type == Pango.Weight and x.value == Pango.Weight.BOLD:
-                    elem = doc.createElement ("attribute")
-                    self.element.appendChild (elem)
-                    elem.setAttribute("start", str(r[0]))
-                    elem.setAttribute("end", str(r[1]))
-                    elem.setAttribute("type", "bold")
-                elif x.type == Pango.Style and x.value == Pango.Style.ITALIC:
-                    elem = doc.createElement ("attribute")
-                    self.element.appendChild (elem)
-                    elem.setAttribute("start", str(r[0]))
-                    elem.setAttribute("end", str(r[1]))
-                    elem.setAttribute("type", "italics")
-                elif x.type == Pango.Underline and x.value == Pango.Underline.SINGLE:
-                    elem = doc.createElement ("attribute")
-                    self.element.appendChild (elem)
-                    elem.setAttribute("start", str(r[0]))
-                    elem.setAttribute("end", str(r[1]))
-                    elem.setAttribute("type", "underline")
-                elif x.type == Pango.AttrFontDesc:
-                    elem = doc.createElement ("attribute")
-                    self.element.appendChild (elem)
-                    elem.setAttribute("start", str(r[0]))
-                    elem.setAttribute("end", str(r[1]))
-                    elem.setAttribute("type", "font")
-                    elem.setAttribute("value", x.desc.to_string ())
-            if not it.next():
-                break
+    def get_save_attributes (self):
+        attrs = super (LabelThought, self).get_save_attributes ()
+        attrs["edge"] = str(self.edge)
+        return attrs
 
     def load (self, node, tar):
         self.index = int (node.getAttribute ("cursor"))
@@ -43,18 +43,19 @@ class Link (GObject.GObject):
                          popup_requested     = (GObject.SIGNAL_RUN_FIRST,
                                                  GObject.TYPE_NONE,
                                                  (GObject.TYPE_PYOBJECT, GObject.TYPE_INT)))
-    def __init__ (self, save, parent = None, child = None, start_coords = None, end_coords = None, strength = 2):
+    def __init__ (self, parent = None, child = None, start_coords = None, end_coords = None, strength = 2):
         super (Link, self).__init__()
         self.parent = parent
         self.child = child
         self.end = end_coords
         self.start = start_coords
         self.strength = strength
-        self.element = save.createElement ("link")
         self.selected = False
         self.color = utils.gtk_to_cairo_color(Gdk.Color.parse("black"))
         self.model_iter = None
         self.text = None
+        self.bounds = None
+        self.save_cache = None
 
         if not self.start and parent and parent.lr:
             self.start = (parent.ul[0]-((parent.ul[0]-parent.lr[0]) / 2.), \
@@ -63,9 +64,6 @@ class Link (GObject.GObject):
         if parent and child:
             self.find_ends ()
 
-    def get_save_element (self):
-        return self.element
-
     def includes (self, coords):
         # TODO: Change this to make link selection work.  Also needs
         # some fairly large changes in MMapArea
@@ -97,9 +95,11 @@ class Link (GObject.GObject):
 
     def set_end (self, coords):
         self.end = coords
+        self.update_bounds ()
 
     def set_strength (self, strength):
         self.strength = strength
+        self.update_bounds ()
 
     def change_strength (self, thought, thought2):
         if not self.connects (thought, thought2):
@@ -108,6 +108,7 @@ class Link (GObject.GObject):
             self.strength += 1
         else:
             self.strength -= 1
+        self.update_bounds ()
         return self.strength != 0
 
     def set_child (self, child):
@@ -119,27 +120,55 @@ class Link (GObject.GObject):
 
     def find_ends (self):
         (self.start, self.end) = self.parent.find_connection (self.child)
+        self.update_bounds ()
 
-    def draw (self, context):
+    def control_points (self):
+        dx = self.end[0] - self.start[0]
+        return ((self.start[0] + dx / 2.0, self.start[1]),
+                (self.end[0] - dx / 2.0, self.end[1]))
+
+    def update_bounds (self):
+        ''' Work out the box the link is drawn in, control points and \
+            line width included.  None if the link has no ends yet'''
+        if not self.start or not self.end:
+            self.bounds = None
+            return
+        xs = [self.start[0], self.end[0]]
+        ys = [self.start[1], self.end[1]]
+        if utils.use_bezier_curves:
+            for (x, y) in self.control_points ():
+                xs.append (x)
+                ys.append (y)
+        pad = abs(self.strength) / 2.0 + 1
+        self.bounds = (min(xs) - pad, min(ys) - pad, max(xs) + pad, max(ys) + pad)
+
+    def get_color (self):
+        if self.selected:
+            return tuple(utils.selected_colors["bg"][:3])
+        return tuple(self.color[:3])
+
+    def add_to_path (self, context):
+        ''' Add the link to the current path without stroking it, so \
+            that links sharing colour and width can be stroked together'''
         if not self.start or not self.end:
             return
-        cwidth = context.get_line_width ()
-        context.set_line_width (self.strength)
         context.move_to (self.start[0], self.start[1])
 
         if utils.use_bezier_curves:
-            dx = self.end[0] - self.start[0]
-            x2 = self.start[0] + dx / 2.0
-            x3 = self.end[0] - dx / 2.0
-            context.curve_to(x2, self.start[1], x3, self.end[1], self.end[0], self.end[1])
+            (x2, y2), (x3, y3) = self.control_points ()
+            context.curve_to(x2, y2, x3, y3, self.end[0], self.end[1])
         else:
             context.line_to (self.end[0], self.end[1])
 
-        if self.selected:
-            color = utils.selected_colors["bg"]
-            context.set_source_rgb (color[0], color[1], color[2])
-        else:
-            context.set_source_rgb (self.color[0], self.color[1], self.color[2])
+    def draw (self, context):
+        if not self.start or not self.end:
+            return
+        cwidth = context.get_line_width ()
+        context.set_line_width (self.strength)
+        self.add_to_path (context)
+
+        color = self.get_color ()
+        context.set_source_rgb (color[0], color[1], color[2])
         context.stroke ()
         context.set_line_width (cwidth)
         context.set_source_rgb (0.0, 0.0, 0.0)
@@ -176,19 +205,33 @@ class Link (GObject.GObject):
         if self.parent and self.child:
             self.find_ends ()
 
-    def update_save (self):
-        self.element.setAttribute ("start", str(self.start))
-        self.element.setAttribute ("end", str(self.end))
-        self.element.setAttribute ("strength", str(self.strength))
-        self.element.setAttribute ("color", str(self.color))
+    def get_save_attributes (self):
+        attrs = {"start": str(self.start),
+                 "end": str(self.end),
+                 "strength": str(self.strength),
+                 "color": str(self.color)}
         if self.child:
-            self.element.setAttribute ("child", str(self.child.identity))
+            attrs["child"] = str(self.child.identity)
         else:
-            self.element.setAttribute ("child", "None")
+            attrs["child"] = "None"
         if self.parent:
-            self.element.setAttribute ("parent", str(self.parent.identity))
+            attrs["parent"] = str(self.parent.identity)
         else:
-            self.element.setAttribute ("parent", "None")
+            attrs["parent"] = "None"
+        return attrs
+
+    def get_save_key (self):
+        return sorted (self.get_save_attributes ().iteritems ())
+
+    def get_save_fragment (self):
+        key = self.get_save_key ()
+        if self.save_cache is None or self.save_cache[0] != key:
+            self.save_cache = (key, utils.xml_fragment (self.serialize))
+        return self.save_cache[1]
+
+    def serialize (self, writer):
+        writer.startElement ("link", utils.sax_attributes (self.get_save_attributes ()))
+        writer.endElement ("link")
 
     def load (self, node):
         self.parent_number = self.child_number = -1
@@ -203,6 +246,7 @@ class Link (GObject.GObject):
             return
         self.start = utils.parse_coords (tmp)
         self.strength = int(node.getAttribute ("strength"))
+        self.update_bounds ()
         try:
             colors = node.getAttribute ("color").split()
             self.color = (float(colors[0].strip('(,)')), float(colors[1].strip('(,)')), float(colors[2].strip('(,)')))
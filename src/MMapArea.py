@@ -29,7 +29,7 @@ import cairo
 import logging
 _ = gettext.gettext
 
-import xml.dom.minidom as dom
+import xml.dom.pulldom as pulldom
 
 from gi.repository import Gtk
 from gi.repository import Gdk
@@ -43,6 +43,11 @@ import ImageThought
 import DrawingThought
 import ResourceThought
 import UndoManager
+import SpatialIndex
+import OrderedSet
+import RenderCache
+import ImageCache
+import MapSaver
 import utils
 from BaseThought import BaseThought
 from Links import Link
@@ -65,6 +70,10 @@ VIEW_BEZIER = 1
 # TODO: Need to expand to support popup menus
 MENU_EMPTY_SPACE = 0
 
+# Extra room (in map coordinates) redrawn around a changed object, for
+# outlines and such drawn just outside of its bounds
+DAMAGE_PAD = 4
+
 # UNDO actions
 UNDO_MOVE = 0
 UNDO_CREATE = 1
@@ -112,18 +121,34 @@ class MMapArea (Gtk.DrawingArea):
                       GObject.TYPE_BOOLEAN, Pango.FontDescription)),
         link_selected = (GObject.SIGNAL_RUN_FIRST,
                          GObject.TYPE_NONE,
-                         ()))
+                         ()),
+        map_changed = (GObject.SIGNAL_RUN_LAST,
+                       GObject.TYPE_NONE,
+                       ()))
 
     def __init__(self, undo):
         super (MMapArea, self).__init__()
 
         self.thoughts = []
-        self.links = []
-        self.selected = []
+        self.links = OrderedSet.OrderedSet()
+        # The links of every thought, those between every pair of
+        # thoughts, and the (parent, child) a link was filed under
+        self.thought_links = {}
+        self.link_pairs = {}
+        self.link_ends = {}
+        self.thought_index = SpatialIndex.SpatialGrid()
+        self.link_index = SpatialIndex.SpatialGrid()
+        self.render_cache = RenderCache.RenderCache()
+        self.image_store = ImageCache.ImageStore()
+        # Set while a map is loaded, its thoughts aren't changes then
+        self.loading = False
+        self.hovered = None
+        self.selected = OrderedSet.OrderedSet()
         self.num_selected = 0
         self.primary = None
         self.pango_context = self.create_pango_context()
         self.undo = undo
+        self.undo.set_changed_cb (self.undo_changed_cb)
         self.scale_fac = 1.0
         self.translate = False
         self.translation = [0.0,0.0]
@@ -131,12 +156,11 @@ class MMapArea (Gtk.DrawingArea):
         self.current_cursor = None
         self.do_filter = True
         self.is_bbox_selecting = False
+        self.bbox_rect = None
+        self.bbox_changed = False
 
         self.nthoughts = 0
 
-        impl = dom.getDOMImplementation()
-        self.save = impl.createDocument("http://www.donscorgie.blueyonder.co.uk/labns", "MMap", None)
-        self.element = self.save.documentElement
         self.im_context = Gtk.IMMulticontext ()
 
         self.mode = MODE_NULL
@@ -261,6 +285,8 @@ class MMapArea (Gtk.DrawingArea):
 
         elif event.button == 1 and self.mode == MODE_NULL:
             self.bbox_origin = coords
+            self.bbox_rect = None
+            self.bbox_changed = False
             self.is_bbox_selecting = True
 
     def undo_move (self, action, mode):
@@ -289,7 +315,14 @@ class MMapArea (Gtk.DrawingArea):
 
         if self.is_bbox_selecting:
             self.is_bbox_selecting = False
-            self.invalidate ()
+            if self.bbox_changed and self.selected:
+                self.hookup_im_context ()
+                self.update_selection (self.selected[-1])
+            elif self.bbox_changed:
+                # The band was dragged off everything it had selected
+                self.hookup_im_context ()
+                self.emit ("change_buffer", None)
+            self.damage_outline (self.bbox_rect)
             try:
                 if abs(self.bbox_origin[0] - coords[0]) > 2.0:
                     return True
@@ -406,7 +439,7 @@ class MMapArea (Gtk.DrawingArea):
 
         if event.state & Gdk.ModifierType.BUTTON1_MASK and self.is_bbox_selecting:
             self.bbox_current = coords
-            self.invalidate()
+            self.damage_outline (self.bbox_rect)
 
             ul = [ self.bbox_origin[0], self.bbox_origin[1] ]
             lr = [ coords[0], coords[1] ]
@@ -425,15 +458,8 @@ class MMapArea (Gtk.DrawingArea):
                 lr[0] = coords[0]
                 lr[1] = self.bbox_origin[1]
 
-            # FIXME: O(n) runtime is bad
-            for t in self.thoughts:
-                if t.lr[0] > ul[0] and t.ul[1] < lr[1] and t.ul[0] < lr[0] and t.lr[1] > ul[1] :
-                    if t not in self.selected:
-                        self.select_thought(t, Gdk.ModifierType.SHIFT_MASK)
-                else:
-                    if t in self.selected:
-                        t.unselect()
-                        self.selected.remove(t)
+            self.update_bbox_selection ((ul[0], ul[1], lr[0], lr[1]))
+            self.damage_outline (self.bbox_rect)
             return True
         elif self.moving:
             self.set_cursor(Gdk.CursorType.FLEUR)
@@ -443,7 +469,6 @@ class MMapArea (Gtk.DrawingArea):
             for t in self.selected:
                 t.move_by (coords[0] - self.move_origin_new[0], coords[1] - self.move_origin_new[1])
             self.move_origin_new = (coords[0], coords[1])
-            self.invalidate ()
             return True
         elif event.state & Gdk.ModifierType.BUTTON2_MASK or \
                 event.state & Gdk.ModifierType.BUTTON1_MASK and self.translate:
@@ -465,15 +490,66 @@ class MMapArea (Gtk.DrawingArea):
 
     def find_object_at (self, coords):
         if self.focus and self.focus.includes(coords):
+            self.hovered = self.focus
             return self.focus
-        for x in reversed(self.thoughts):
-            if x != self.focus and not isinstance(x, Link) and x.includes (coords):
-                return x
-        for x in self.links:
-            if x != self.focus and not isinstance(x, Link) and x.includes (coords):
+        candidates = self.thought_index.query_point (coords[0], coords[1])
+        # includes() also updates the resize state and mouse cursor of a
+        # thought, so let the one we were over last know we left it
+        if self.hovered and self.hovered != self.focus and \
+                self.hovered not in candidates:
+            self.hovered.includes (coords)
+        self.hovered = None
+        for x in self.thought_index.sorted (candidates, reverse = True):
+            if x != self.focus and x.includes (coords):
+                self.hovered = x
                 return x
         return None
 
+    def update_bbox_selection (self, rect):
+        ''' Make the selection match the rubber band rect.  Only the \
+            thoughts near the area that changed since the last motion \
+            event are looked at.  Signals and the current root are left \
+            for button_release'''
+        old = self.bbox_rect
+        self.bbox_rect = rect
+        if old is None:
+            candidates = self.thought_index.query_rect (rect)
+            # Drop whatever was selected before outside of the rect
+            for t in [x for x in self.selected if x in self.thought_index and \
+                      x not in candidates]:
+                t.unselect ()
+                self.selected.remove (t)
+                self.bbox_changed = True
+                self.damage (self.thought_index.get_bounds (t))
+        else:
+            candidates = self.thought_index.query_change (old, rect)
+        for t in candidates:
+            if t.lr[0] > rect[0] and t.ul[1] < rect[3] and t.ul[0] < rect[2] and t.lr[1] > rect[1]:
+                if t not in self.selected:
+                    self.selected.append (t)
+                    t.select ()
+                    self.bbox_changed = True
+                    self.damage (self.thought_index.get_bounds (t))
+            elif t in self.selected:
+                t.unselect ()
+                self.selected.remove (t)
+                self.bbox_changed = True
+                self.damage (self.thought_index.get_bounds (t))
+
+    def thought_bounds (self, thought):
+        if not thought.ul or not thought.lr:
+            return None
+        pad = thought.sensitive
+        return (thought.ul[0] - pad, thought.ul[1] - pad,
+                thought.lr[0] + pad, thought.lr[1] + pad)
+
+    def update_index (self, thought):
+        ''' Tell the spatial index where thought is now.  Returns the \
+            bounds it had before'''
+        if thought not in self.thought_index:
+            return None
+        return self.thought_index.update (thought, self.thought_bounds (thought))
+
     def realize_cb (self, widget):
         self.disconnect (self.realize_handle)
         if self.mode == MODE_IMAGE or self.mode == MODE_DRAW:
@@ -550,10 +626,10 @@ class MMapArea (Gtk.DrawingArea):
         self.hookup_im_context ()
         for t in self.selected:
             t.unselect ()
-        self.selected = []
+        self.selected = OrderedSet.OrderedSet()
 
     def select_link (self, link, modifiers):
-        if modifiers and modifiers & Gdk.ModifierType.SHIFT_MASK and len (self.selected) > 1 and self.selected.count (link) > 0:
+        if modifiers and modifiers & Gdk.ModifierType.SHIFT_MASK and len (self.selected) > 1 and link in self.selected:
             self.selected.remove (link)
             link.unselect ()
             return
@@ -562,11 +638,10 @@ class MMapArea (Gtk.DrawingArea):
         self.set_focus(None, None)
 
         if modifiers and (modifiers & Gdk.ModifierType.SHIFT_MASK or modifiers == -1):
-            if self.selected.count (link) == 0:
-                self.selected.append (link)
+            self.selected.append (link)
         else:
             map (lambda t : t.unselect(), self.selected)
-            self.selected = [link]
+            self.selected = OrderedSet.OrderedSet([link])
         link.select()
         self.emit("change_buffer", None)
 
@@ -585,21 +660,26 @@ class MMapArea (Gtk.DrawingArea):
         if thought in self.selected and self.moving:
             return
 
-        if thought not in self.thoughts:
+        if thought not in self.thought_index:
             self.thoughts.append(thought)
+            self.thought_index.insert (thought, self.thought_bounds (thought))
 
         if modifiers and (modifiers & Gdk.ModifierType.SHIFT_MASK or modifiers == -1):
-            if self.selected.count (thought) == 0:
-                self.selected.append (thought)
+            self.selected.append (thought)
         else:
             map(lambda x : x.unselect(), self.selected)
-            self.selected = [thought]
+            self.selected = OrderedSet.OrderedSet([thought])
+        thought.select ()
+        self.update_selection (thought)
+
+    def update_selection (self, thought):
+        ''' Rebuild the current root and tell everyone about the \
+            selection, thought being the last one that got selected'''
         if thought.can_be_parent():
             self.current_root = []
         for x in self.selected:
             if x.can_be_parent():
                 self.current_root.append(x)
-        thought.select ()
         if len(self.selected) == 1:
             self.emit ("thought_selection_changed", thought.background_color, thought.foreground_color)
             self.background_color = thought.background_color
@@ -618,14 +698,12 @@ class MMapArea (Gtk.DrawingArea):
         link = action.args[0]
         if action.undo_type == UNDO_CREATE_LINK:
             if mode == UndoManager.REDO:
-                self.element.appendChild (link.element)
-                self.links.append (link)
+                self.register_link (link)
             else:
                 self.delete_link (link)
         elif action.undo_type == UNDO_DELETE_LINK:
             if mode == UndoManager.UNDO:
-                self.element.appendChild (link.element)
-                self.links.append (link)
+                self.register_link (link)
             else:
                 self.delete_link (link)
         elif action.undo_type == UNDO_STRENGTHEN_LINK:
@@ -633,6 +711,7 @@ class MMapArea (Gtk.DrawingArea):
                 link.set_strength (action.args[1])
             else:
                 link.set_strength (action.args[2])
+            self.update_link_index (link)
 
         self.undo.unblock ()
         self.invalidate ()
@@ -642,48 +721,147 @@ class MMapArea (Gtk.DrawingArea):
         link.connect ("update_view", self.update_view)
 
     def create_link (self, thought, thought_coords, child, child_coords = None, strength = 2):
-        for x in self.links:
-            if x.connects (thought, child):
-                if x.change_strength (thought, child):
-                    self.delete_link (x)
-                return
-        link = Link (self.save, parent = thought, child = child, strength = strength)
+        for x in self.links_between (thought, child):
+            if x.change_strength (thought, child):
+                self.delete_link (x)
+            else:
+                self.update_link_index (x)
+            return
+        link = Link (parent = thought, child = child, strength = strength)
         self.connect_link (link)
-        element = link.get_save_element ()
-        self.element.appendChild (element)
-        self.links.append (link)
+        self.register_link (link)
 
         return link
 
+    def register_link (self, link):
+        self.links.append (link)
+        self.link_index.insert (link, link.bounds)
+        self.index_link_ends (link)
+
+    def unregister_link (self, link):
+        self.links.remove (link)
+        self.link_index.remove (link)
+        self.unindex_link_ends (link)
+
+    def index_link_ends (self, link):
+        ''' File link under its parent and child.  Has to be called again \
+            whenever those change'''
+        self.unindex_link_ends (link)
+        ends = (link.parent, link.child)
+        self.link_ends[link] = ends
+        for t in set (ends):
+            if t is not None:
+                self.thought_links.setdefault (t, OrderedSet.OrderedSet()).add (link)
+        if None not in ends:
+            self.link_pairs.setdefault (frozenset (ends), OrderedSet.OrderedSet()).add (link)
+
+    def unindex_link_ends (self, link):
+        ends = self.link_ends.pop (link, None)
+        if ends is None:
+            return
+        for t in set (ends):
+            links = self.thought_links.get (t)
+            if links is not None:
+                links.discard (link)
+                if not links:
+                    del self.thought_links[t]
+        pair = frozenset (ends)
+        links = self.link_pairs.get (pair)
+        if links is not None:
+            links.discard (link)
+            if not links:
+                del self.link_pairs[pair]
+
+    def links_of (self, thought):
+        ''' The links from or to thought '''
+        return list (self.thought_links.get (thought, ()))
+
+    def links_between (self, thought, thought2):
+        ''' The links connecting thought and thought2, either way '''
+        return list (self.link_pairs.get (frozenset ((thought, thought2)), ()))
+
+    def update_link_index (self, link):
+        ''' Returns the bounds link had before, None if it is not \
+            indexed'''
+        if link not in self.link_index:
+            return None
+        return self.link_index.update (link, link.bounds)
+
     def set_mouse_cursor_cb (self, thought, cursor_type):
         if not self.moving:
             self.set_cursor (cursor_type)
 
     def update_all_links(self):
-        map(lambda l : l.find_ends(), self.links)
+        for l in self.links:
+            l.find_ends ()
+            self.update_link_index (l)
 
     def update_links_cb (self, thought):
-        for x in self.links:
-            if x.uses (thought):
-                x.find_ends ()
+        self.reindex (thought)
+        for x in self.links_of (thought):
+            x.find_ends ()
+            self.damage (self.update_link_index (x))
+            self.damage (x.bounds)
 
     def update_view (self, thought):
-        self.invalidate ()
+        if thought in self.link_index:
+            self.damage (thought.bounds)
+        elif thought in self.thought_index:
+            self.reindex (thought)
+            self.damage (self.thought_index.get_bounds (thought))
+        else:
+            self.invalidate ()
+
+    def reindex (self, thought):
+        ''' Update the index for thought, redrawing where it was and \
+            where it is now if it moved or changed size'''
+        old = self.update_index (thought)
+        new = self.thought_index.get_bounds (thought)
+        if old != new:
+            if old is not None:
+                self.damage (old)
+            self.damage (new)
+
+    def damage (self, bounds):
+        ''' Have the area bounds (x0, y0, x1, y1 in map coordinates) \
+            redrawn.  Objects without bounds redraw everything'''
+        if bounds is None:
+            self.invalidate ()
+            return
+        self.invalidate ((bounds[0] - DAMAGE_PAD, bounds[1] - DAMAGE_PAD,
+                          bounds[2] + DAMAGE_PAD, bounds[3] + DAMAGE_PAD))
+
+    def damage_outline (self, rect):
+        ''' Have the edges of rect redrawn, but not its inside '''
+        if rect is None:
+            return
+        x0, y0, x1, y1 = rect
+        self.damage ((x0, y0, x1, y0))
+        self.damage ((x0, y1, x1, y1))
+        self.damage ((x0, y0, x0, y1))
+        self.damage ((x1, y0, x1, y1))
 
     def invalidate (self, transformed_area = None):
-        '''Helper function to invalidate the entire screen, forcing a redraw'''
-        rect = None
-        if not transformed_area:
+        '''Helper function to invalidate the screen, forcing a redraw.  \
+           transformed_area is (x0, y0, x1, y1) in map coordinates, \
+           without it the entire screen is redrawn'''
+        ul = lr = None
+        if transformed_area:
+            ul = self.untransform_coords(transformed_area[0], transformed_area[1])
+            lr = self.untransform_coords(transformed_area[2], transformed_area[3])
+        rect = Gdk.Rectangle()
+        if not ul or not lr:
             alloc = self.get_allocation ()
-            rect = Gdk.Rectangle()
             rect.x = 0
             rect.y = 0
             rect.width = alloc.width
             rect.height = alloc.height
         else:
-            ul = self.untransform_coords(transformed_area[0], transformed_area[1])
-            lr = self.untransform_coords(transformed_area[2], transformed_area[3])
-            rect = Gdk.Rectangle (int(ul[0]), int(ul[1]), int(lr[0]-ul[0]), int(lr[1]-ul[1]))
+            # One extra pixel on each side for antialiasing
+            rect.x = int(math.floor(min(ul[0], lr[0]))) - 1
+            rect.y = int(math.floor(min(ul[1], lr[1]))) - 1
+            rect.width = int(math.ceil(max(ul[0], lr[0]))) - rect.x + 2
+            rect.height = int(math.ceil(max(ul[1], lr[1]))) - rect.y + 2
         if self.window:
             self.window.invalidate_rect (rect, True)
 
@@ -716,22 +894,19 @@ class MMapArea (Gtk.DrawingArea):
         context.translate(-alloc.width/2., -alloc.height/2.)
         context.translate(self.translation[0], self.translation[1])
 
-        for l in self.links:
-            l.draw (context)
-
         self.untransform = context.get_matrix()
         self.transform = context.get_matrix()
         self.transform.invert()
 
-        ax, ay = self.transform_coords(area.x, area.y)
-        width  = area.width / self.scale_fac
-        height = area.height / self.scale_fac
-        for t in self.thoughts:
-            try:
-                if t.lr[0] >= ax and t.ul[0] <= ax + width and t.lr[1] >= ay and t.ul[1] <= ay + height:
-                    t.draw (context)
-            except:
-                t.draw(context)
+        # Only what intersects the damaged part of the screen needs drawing
+        damaged = context.clip_extents ()
+        self.draw_links (context, damaged)
+        for t in self.thought_index.sorted (self.thought_index.query_rect (damaged)):
+            if not utils.use_render_cache or \
+                    not self.render_cache.draw (t, context, self.scale_fac):
+                t.draw (context)
+            # Drawing recalculates the edges of some thoughts
+            self.reindex (t)
 
         if self.is_bbox_selecting:
             xs = self.bbox_origin[0]
@@ -763,6 +938,30 @@ class MMapArea (Gtk.DrawingArea):
 
         return False
 
+    def draw_links (self, context, rect):
+        ''' Draw the links that can be seen in rect.  Links with the same \
+            colour and width go into a single path, stroked once'''
+        groups = {}
+        order = []
+        for l in self.link_index.sorted (self.link_index.query_rect (rect)):
+            key = (l.get_color (), l.strength)
+            if key not in groups:
+                groups[key] = []
+                order.append (key)
+            groups[key].append (l)
+        if not order:
+            return
+        cwidth = context.get_line_width ()
+        for key in order:
+            color, strength = key
+            for l in groups[key]:
+                l.add_to_path (context)
+            context.set_line_width (strength)
+            context.set_source_rgb (color[0], color[1], color[2])
+            context.stroke ()
+        context.set_line_width (cwidth)
+        context.set_source_rgb (0.0, 0.0, 0.0)
+
     def undo_create_cb (self, action, mode):
         self.undo.block ()
         if mode == UndoManager.UNDO:
@@ -775,15 +974,14 @@ class MMapArea (Gtk.DrawingArea):
             self.emit ("change_mode", action.args[2])
             thought = action.args[0]
             self.thoughts.append (thought)
+            self.thought_index.insert (thought, self.thought_bounds (thought))
             for t in action.args[1]:
                 self.unselect_all ()
                 self.select_thought (t, -1)
             self.hookup_im_context (thought)
             self.emit ("change_buffer", thought.extended_buffer)
-            self.element.appendChild (thought.element)
             for l in action.args[5:]:
-                self.links.append (l)
-                self.element.appendChild (l.element)
+                self.register_link (l)
 
         self.emit ("set_focus", None, False)
         self.undo.unblock ()
@@ -797,24 +995,22 @@ class MMapArea (Gtk.DrawingArea):
 
         if type == MODE_TEXT:
             # fixed<-_vbox<-_sw<-_main_area
-            thought = TextThought.TextThought (coords, self.pango_context, self.nthoughts, self.save, self.undo, loading, self.background_color, self.foreground_color, fixed=self.get_parent().get_parent().get_parent().get_parent(), parent=self)
+            thought = TextThought.TextThought (coords, self.pango_context, self.nthoughts, self.undo, loading, self.background_color, self.foreground_color, fixed=self.get_parent().get_parent().get_parent().get_parent(), parent=self)
         elif type == MODE_LABEL:
-            thought = LabelThought.LabelThought (coords, self.pango_context, self.nthoughts, self.save, self.undo, loading, self.background_color, self.foreground_color)
+            thought = LabelThought.LabelThought (coords, self.pango_context, self.nthoughts, self.undo, loading, self.background_color, self.foreground_color)
         elif type == MODE_IMAGE:
-            thought = ImageThought.ImageThought (coords, self.pango_context, self.nthoughts, self.save, self.undo, loading, self.background_color, self.foreground_color)
+            thought = ImageThought.ImageThought (coords, self.pango_context, self.nthoughts, self.undo, loading, self.background_color, self.foreground_color, store=self.image_store)
         elif type == MODE_DRAW:
-            thought = DrawingThought.DrawingThought (coords, self.pango_context, self.nthoughts, self.save, self.undo,    \
+            thought = DrawingThought.DrawingThought (coords, self.pango_context, self.nthoughts, self.undo,    \
                                                      loading,self.background_color, self.foreground_color)
         elif type == MODE_RESOURCE:
-            thought = ResourceThought.ResourceThought (coords, self.pango_context, self.nthoughts, self.save, self.undo, loading, self.background_color, self.foreground_color)
+            thought = ResourceThought.ResourceThought (coords, self.pango_context, self.nthoughts, self.undo, loading, self.background_color, self.foreground_color)
         if not thought.okay ():
             return None
 
         if type == MODE_IMAGE:
             self.emit ("change_mode", self.old_mode)
         self.nthoughts += 1
-        element = thought.element
-        self.element.appendChild (thought.element)
         thought.connect ("select_thought", self.select_thought)
         thought.connect ("create_link", self.create_link)
         thought.connect ("update_view", self.update_view)
@@ -823,7 +1019,9 @@ class MMapArea (Gtk.DrawingArea):
         thought.connect ("update_links", self.update_links_cb)
         thought.connect ("grab_focus", self.regain_focus_cb)
         thought.connect ("update-attrs", self.update_attr_cb)
+        thought.connect ("changed", self.thought_changed_cb)
         self.thoughts.append (thought)
+        self.thought_index.insert (thought, self.thought_bounds (thought))
         return thought
 
     def regain_focus_cb (self, thought, ext):
@@ -841,9 +1039,11 @@ class MMapArea (Gtk.DrawingArea):
         if hasattr(thought, 'textview'):
             thought.remove_textview()
 
-        if thought.element in self.element.childNodes:
-            self.element.removeChild (thought.element)
         self.thoughts.remove (thought)
+        self.thought_index.remove (thought)
+        self.render_cache.forget (thought)
+        if self.hovered == thought:
+            self.hovered = None
         try:
             self.selected.remove (thought)
         except:
@@ -857,11 +1057,9 @@ class MMapArea (Gtk.DrawingArea):
             self.primary = None
             if self.thoughts:
                 self.make_primary (self.thoughts[0])
-        rem_links = []
-        for l in self.links:
-            if l.uses (thought):
-                if action: action.add_arg (l)
-                rem_links.append (l)
+        rem_links = self.links_of (thought)
+        for l in rem_links:
+            if action: action.add_arg (l)
         for l in rem_links:
             self.delete_link (l)
 
@@ -880,12 +1078,11 @@ class MMapArea (Gtk.DrawingArea):
         if mode == UndoManager.UNDO:
             self.unselect_all ()
             for l in action.args[1:]:
-                self.links.append (l)
-                self.element.appendChild (l.element)
+                self.register_link (l)
             for t in action.args[0]:
                 self.thoughts.append (t)
+                self.thought_index.insert (t, self.thought_bounds (t))
                 self.select_thought (t, -1)
-                self.element.appendChild (t.element)
                 if t.am_primary and not self.primary:
                     self.emit ("change_buffer", action.args[0][0].extended_buffer)
                     self.make_primary(t)
@@ -911,9 +1108,8 @@ class MMapArea (Gtk.DrawingArea):
             t = tmp.pop()
             while t:
                 if t in self.thoughts:
-                    for l in self.links:
-                        if l.uses (t):
-                            action.add_arg (l)
+                    for l in self.links_of (t):
+                        action.add_arg (l)
                     self.delete_thought (t)
                 if t in self.links:
                     self.delete_link (t)
@@ -928,11 +1124,8 @@ class MMapArea (Gtk.DrawingArea):
         self.invalidate ()
 
     def delete_link (self, link):
-        if link.element in self.element.childNodes:
-            self.element.removeChild (link.element)
-        #link.element.unlink ()
         try:
-            self.links.remove (link)
+            self.unregister_link (link)
         except:
             pass
 
@@ -973,7 +1166,7 @@ class MMapArea (Gtk.DrawingArea):
         if len(self.selected) != 1:
             return None
         initial = self.selected[0]
-        for x in self.links:
+        for x in self.links_of (initial):
             if x.parent == initial:
                 other = x.child
             elif x.child == initial:
@@ -1094,37 +1287,80 @@ class MMapArea (Gtk.DrawingArea):
         thought.load (node, tar)
 
     def load_link (self, node):
-        link = Link (self.save)
+        link = Link ()
         self.connect_link (link)
         link.load (node)
-        self.links.append (link)
-        element = link.get_save_element ()
-        self.element.appendChild (element)
+        self.register_link (link)
+
+    def load_node (self, node, tar):
+        if node.nodeName == "thought":
+            self.load_thought (node, MODE_TEXT, tar)
+        elif node.nodeName == "label_thought":
+            self.load_thought (node, MODE_LABEL, tar)
+        elif node.nodeName == "image_thought":
+            self.load_thought (node, MODE_IMAGE, tar)
+        elif node.nodeName == "drawing_thought":
+            self.load_thought (node, MODE_DRAW, tar)
+        elif node.nodeName == "res_thought":
+            self.load_thought (node, MODE_RESOURCE, tar)
+        elif node.nodeName == "link":
+            self.load_link (node)
+        else:
+            print "Warning: Unknown element type.  Ignoring: "+node.nodeName
 
     def load_thyself (self, top_element, doc, tar):
-        for node in top_element.childNodes:
-            if node.nodeName == "thought":
-                self.load_thought (node, MODE_TEXT, tar)
-            elif node.nodeName == "label_thought":
-                self.load_thought (node, MODE_LABEL, tar)
-            elif node.nodeName == "image_thought":
-                self.load_thought (node, MODE_IMAGE, tar)
-            elif node.nodeName == "drawing_thought":
-                self.load_thought (node, MODE_DRAW, tar)
-            elif node.nodeName == "res_thought":
-                self.load_thought (node, MODE_RESOURCE, tar)
-            elif node.nodeName == "link":
-                self.load_link (node)
-            else:
-                print "Warning: Unknown element type.  Ignoring: "+node.nodeName
+        self.loading = True
+        try:
+            for node in top_element.childNodes:
+                if node.nodeType == node.ELEMENT_NODE:
+                    self.load_node (node, tar)
 
-        self.finish_loading ()
+            self.finish_loading ()
+        finally:
+            self.loading = False
+
+    def load_stream (self, stream, tar, start_cb = None):
+        ''' Load the map from a MANIFEST file object without building a \
+            DOM of the whole file.  Each thought and link is expanded, \
+            loaded and dropped in turn.  start_cb is called with the top \
+            element (without children) before anything gets loaded. \
+            Returns the top element'''
+        events = pulldom.parse (stream)
+        top_element = None
+        depth = 0
+        self.loading = True
+        try:
+            for event, node in events:
+                if event == pulldom.START_ELEMENT:
+                    if depth == 0:
+                        top_element = node
+                        if start_cb:
+                            start_cb (top_element)
+                        depth = 1
+                    else:
+                        events.expandNode (node)
+                        # pulldom hands text over in pieces (at newlines
+                        # and entities), the thoughts expect it in one
+                        node.normalize ()
+                        self.load_node (node, tar)
+                        node.unlink ()
+                elif event == pulldom.END_ELEMENT:
+                    depth -= 1
+
+            self.finish_loading ()
+        finally:
+            self.loading = False
+        return top_element
 
     def finish_loading (self):
         # Possible TODO: This all assumes we've been given a proper,
         # consistant file.  It should fallback nicely, but...
         # First, find the primary root:
+        identities = {}
         for t in self.thoughts:
+            identities.setdefault (t.identity, t)
+            # Thoughts only know where they are once they are loaded
+            self.update_index (t)
             if t.am_primary:
                 self.make_primary (t)
             if t.am_selected:
@@ -1133,7 +1369,7 @@ class MMapArea (Gtk.DrawingArea):
             if t.identity >= self.nthoughts:
                 self.nthoughts = t.identity + 1
         if self.selected:
-            self.current_root = self.selected
+            self.current_root = list(self.selected)
         else:
             self.current_root = [self.primary]
         if len(self.selected) == 1:
@@ -1149,29 +1385,35 @@ class MMapArea (Gtk.DrawingArea):
                (l.parent_number == l.child_number):
                 del_links.append (l)
                 continue
-            parent = child = None
-            for t in self.thoughts:
-                if t.identity == l.parent_number:
-                    parent = t
-                elif t.identity == l.child_number:
-                    child = t
-                if parent and child:
-                    break
+            parent = identities.get (l.parent_number)
+            child = identities.get (l.child_number)
             l.set_parent_child (parent, child)
+            self.update_link_index (l)
+            self.index_link_ends (l)
             if not l.parent or not l.child:
                 del_links.append (l)
         for l in del_links:
             self.delete_link (l)
 
-    def update_save(self):
+    def snapshot(self, attrs):
+        ''' Take a MapSaver.MapSnapshot of the map, with attrs on the top \
+            element.  Only the thoughts and links changed since the last \
+            save are serialized again'''
+        fragments = [t.get_save_fragment () for t in self.thoughts]
+        fragments.extend ([l.get_save_fragment () for l in self.links])
+        members = []
         for t in self.thoughts:
-            t.update_save ()
-        for l in self.links:
-            l.update_save ()
+            members.extend (t.get_save_members ())
+        return MapSaver.MapSnapshot (attrs, fragments, members)
 
-    def save_thyself(self, tar):
-        for t in self.thoughts:
-            t.save(tar)
+    def undo_changed_cb (self):
+        # Structural edits (adding, moving, linking...) go through the
+        # undo manager, editing a thought's content marks it changed
+        self.emit ("map_changed")
+
+    def thought_changed_cb (self, thought):
+        if not self.loading:
+            self.emit ("map_changed")
 
     def text_selection_cb (self, thought, start, end, text):
         self.emit ("text_selection_changed", start, end, text)
@@ -1244,10 +1486,7 @@ class MMapArea (Gtk.DrawingArea):
     def thoughts_are_linked (self):
         if len (self.selected) != 2:
             return False
-        for l in self.links:
-            if l.connects (self.selected[0], self.selected[1]):
-                return True
-        return False
+        return len (self.links_between (self.selected[0], self.selected[1])) > 0
 
     def drag_menu_cb(self, sw, mode):
         if len(self.selected) == 1:
@@ -1310,10 +1549,9 @@ class MMapArea (Gtk.DrawingArea):
             not self.selected[1].can_be_parent():
                 return
         lnk = None
-        for l in self.links:
-            if l.connects (self.selected[0], self.selected[1]):
-                lnk = l
-                break
+        for l in self.links_between (self.selected[0], self.selected[1]):
+            lnk = l
+            break
         if lnk:
             self.undo.add_undo (UndoManager.UndoAction (self, UNDO_DELETE_LINK, self.undo_link_action, lnk))
             self.delete_link (lnk)
@@ -1385,7 +1623,7 @@ class MMapArea (Gtk.DrawingArea):
                         self.create_link (x, None, thought)
             for x in self.selected:
                 x.unselect ()
-            self.selected = [thought]
+            self.selected = OrderedSet.OrderedSet([thought])
             thought.select ()
 
         self.undo.unblock ()
@@ -1393,9 +1631,8 @@ class MMapArea (Gtk.DrawingArea):
         thought.background_color = self.background_color
         act = UndoManager.UndoAction (self, UNDO_CREATE, self.undo_create_cb, thought, sel, \
                                       self.mode, self.old_mode, event.get_coords())
-        for l in self.links:
-            if l.uses (thought):
-                act.add_arg (l)
+        for l in self.links_of (thought):
+            act.add_arg (l)
         """
         if self.undo.peak ().undo_type == UNDO_DELETE_SINGLE:
             last_action = self.undo.pop ()
@@ -22,7 +22,6 @@
 import cairo
 import sha
 import os
-import tarfile
 import gettext
 _ = gettext.gettext
 import MMapArea
@@ -30,8 +29,8 @@ import UndoManager
 import utils
 from MapList import MapList
 import xml.dom.minidom as dom
-import PeriodicSaveThread
-import ImageThought
+import AutoSave
+import MapSaver
 import BaseThought
 
 if os.name != 'nt':
@@ -69,7 +68,6 @@ class LabyrinthWindow (GObject.GObject):
         self.undo.block ()
         self.MainArea = MMapArea.MMapArea (self.undo)
         self.MainArea.connect ("title_changed", self.title_changed_cb)
-        self.MainArea.connect ("doc_save", self.doc_save_cb)
         self.MainArea.connect ("doc_delete", self.doc_del_cb)
         self.MainArea.connect ("change_mode", self.mode_request_cb)
         self.MainArea.connect ("button-press-event", self.main_area_focus_cb)
@@ -202,6 +200,7 @@ class LabyrinthWindow (GObject.GObject):
 
         # Other stuff
         self.width, self.height = self.main_window.get_size ()
+        self.xpos, self.ypos = self.main_window.get_position ()
         
         # if we import, we dump the old filename to create a new hashed one
         self.save_file = None
@@ -214,6 +213,10 @@ class LabyrinthWindow (GObject.GObject):
             self.act.set_current_value (self.mode)
         
         self.undo.unblock ()
+        self.saver = None
+        self.saved_snapshot = None
+        if self.save_file:
+            self.saved_snapshot = self.snapshot ()
         self.start_timer ()
 
     def show(self):
@@ -534,36 +537,31 @@ class LabyrinthWindow (GObject.GObject):
         self.MainArea.delete_selected_elements ()
 
     def close_window_cb (self, event):
-        self.SaveTimer.cancel = True
+        self.SaveTimer.cancel ()
         self.main_window.hide ()
-        self.MainArea.save_thyself ()
+        self.save_now ()
         del (self)
 
     def doc_del_cb (self, widget):
         self.emit ('window_closed', None)
 
-    def serialize_to_xml(self, doc, top_element):
-        top_element.setAttribute ("title", self.title_cp)
-        top_element.setAttribute ("mode", str(self.mode))
-        top_element.setAttribute ("size", str((self.width,self.height)))
-        top_element.setAttribute ("position", str((self.xpos,self.ypos)))
-        top_element.setAttribute ("maximised", str(self.maximised))
-        top_element.setAttribute ("view_type", str(self.view_type))
-        top_element.setAttribute ("pane_position", str(self.pane_pos))
-        top_element.setAttribute ("scale_factor", str(self.MainArea.scale_fac))
-        top_element.setAttribute ("translation", str(self.MainArea.translation))
-        string = doc.toxml ()
-        return string.encode ("utf-8" )
-
-    def save_map(self, filename, string):
-        f = file (filename, 'w')
-        f.write (string)
-        f.close ()
-
-    def doc_save_cb (self, widget, doc, top_element):
-        save_string = self.serialize_to_xml(doc, top_element)
+    def get_manifest_attributes (self):
+        return {"title": self.title_cp,
+                "mode": str(self.mode),
+                "size": str((self.width,self.height)),
+                "position": str((self.xpos,self.ypos)),
+                "maximised": str(self.maximised),
+                "view_type": str(self.view_type),
+                "pane_position": str(self.pane_pos),
+                "scale_factor": str(self.MainArea.scale_fac),
+                "translation": str(self.MainArea.translation)}
+
+    def snapshot (self):
+        return self.MainArea.snapshot (self.get_manifest_attributes ())
+
+    def find_save_file (self, snapshot):
         if not self.save_file:
-            sham = sha.new (save_string)
+            sham = sha.new (''.join (snapshot.fragments))
             save_loc = utils.get_save_dir ()
             self.save_file = save_loc+sham.hexdigest()+".map"
             counter = 1
@@ -572,9 +570,22 @@ class LabyrinthWindow (GObject.GObject):
                 print "Warning: Duplicate File.  Saving to alternative"
                 self.save_file = save_loc + "Dup"+str(counter)+sham.hexdigest()+".map"
                 counter += 1
-
-        self.save_map(self.save_file, save_string)
-        self.emit ('file_saved', self.save_file, self)
+        return self.save_file
+
+    def save_now (self):
+        ''' Write the map before returning, if it changed since the last \
+            save.  An autosave still writing is finished first'''
+        if self.saver is not None:
+            self.saver.wait ()
+        snapshot = self.snapshot ()
+        if snapshot == self.saved_snapshot:
+            return
+        saver = MapSaver.MapSaver (snapshot, self.find_save_file (snapshot),
+                                   utils.map_container)
+        saver.run ()
+        if saver.error is None:
+            self.saved_snapshot = snapshot
+            self.emit ('file_saved', self.save_file, self)
 
     def export_map_cb(self, event):
         chooser = Gtk.FileChooserDialog(title=_("Save File As"), action=Gtk.FILE_CHOOSER_ACTION_SAVE, \
@@ -583,21 +594,25 @@ class LabyrinthWindow (GObject.GObject):
         response = chooser.run()
         if response == Gtk.ResponeType.OK:
             filename = chooser.get_filename ()
-            self.MainArea.save_thyself ()
-            tf = tarfile.open (filename, "w")
-            tf.add (self.save_file, utils.strip_path_from_file_name(self.save_file))
-            for t in self.MainArea.thoughts:
-                if isinstance(t, ImageThought.ImageThought):
-                    tf.add (t.filename, 'images/' + utils.strip_path_from_file_name(t.filename))
-                    
-            tf.close()
+            saver = MapSaver.MapSaver (self.snapshot (), filename)
+            saver.run ()
 
         chooser.destroy()
 
     def parse_file (self, filename):
-        f = file (filename, 'r')
-        doc = dom.parse (f)
-        top_element = doc.documentElement
+        f, tar = utils.open_map (filename)
+        top_element = self.MainArea.load_stream (f, tar, self.parse_top_element)
+        f.close ()
+        if tar is not None:
+            tar.close ()
+        if top_element.hasAttribute("scale_factor"):
+            self.MainArea.scale_fac = float (top_element.getAttribute ("scale_factor"))
+        if top_element.hasAttribute("translation"):
+            tmp = top_element.getAttribute("translation")
+            (x,y) = utils.parse_coords(tmp)
+            self.MainArea.translation = [x,y]
+
+    def parse_top_element (self, top_element):
         self.title_cp = top_element.getAttribute ("title")
         self.mode = int (top_element.getAttribute ("mode"))
         if top_element.hasAttribute ("maximised"):
@@ -629,13 +644,6 @@ class LabyrinthWindow (GObject.GObject):
         self.main_window.move (int (x), int (y))
 
         self.MainArea.set_mode (self.mode)
-        self.MainArea.load_thyself (top_element, doc)
-        if top_element.hasAttribute("scale_factor"):
-            self.MainArea.scale_fac = float (top_element.getAttribute ("scale_factor"))
-        if top_element.hasAttribute("translation"):
-            tmp = top_element.getAttribute("translation")
-            (x,y) = utils.parse_coords(tmp)
-            self.MainArea.translation = [x,y]
 
     def configure_cb (self, window, event):
         self.xpos = event.x
@@ -813,7 +821,24 @@ class LabyrinthWindow (GObject.GObject):
             self.MainArea.paste_clipboard (clip)
 
     def start_timer (self):
-        self.SaveTimer = PeriodicSaveThread.PeriodicSaveThread(self.MainArea)
-        self.SaveTimer.setDaemon( True)
-        self.SaveTimer.start()
+        self.SaveTimer = AutoSave.AutoSave (self.autosave_cb)
+        self.MainArea.connect ("map_changed", self.SaveTimer.changed)
+
+    def autosave_cb (self, done_cb):
+        snapshot = self.snapshot ()
+        if self.saver is not None or snapshot == self.saved_snapshot:
+            done_cb ()
+            return
+
+        def saved_cb (saver):
+            if self.saver is saver:
+                self.saver = None
+            if saver.error is None:
+                self.saved_snapshot = snapshot
+                self.emit ('file_saved', saver.path, self)
+            done_cb ()
+
+        self.saver = MapSaver.MapSaver (snapshot, self.find_save_file (snapshot),
+                                        utils.map_container, saved_cb)
+        self.saver.start ()
 
@@ -21,7 +21,7 @@
 
 import os
 import utils
-import xml.dom.minidom as dom
+import xml.dom.pulldom as pulldom
 import datetime
 
 from gi.repository import Gtk
@@ -46,8 +46,18 @@ class MapList(object):
             self.__dict__["index"] = index
 
         def _read_from_file(self, filename):
-            doc = dom.parse (filename)
-            top_element = doc.documentElement
+            f, tar = utils.open_map (filename)
+            try:
+                # Only the title is needed, the rest isn't parsed
+                events = pulldom.parse (f)
+                for event, node in events:
+                    if event == pulldom.START_ELEMENT:
+                        top_element = node
+                        break
+            finally:
+                f.close ()
+                if tar is not None:
+                    tar.close ()
             self.filename = filename
             self.title = top_element.getAttribute ("title")
             self.window = None
@@ -0,0 +1,132 @@
+# MapSaver.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+import os
+import sys
+import logging
+import tempfile
+import threading
+from xml.sax import saxutils
+
+from gi.repository import GObject
+
+from port.tarball import Tarball
+
+import utils
+
+class MapSnapshot (object):
+    ''' What a map looks like at one moment: the attributes of the top \
+        element, the finished XML of every thought and link, and the \
+        files (images) that go next to the MANIFEST.  None of it is \
+        touched by the map afterwards, so it can be written out from \
+        any thread.  members are (name, data), data being the bytes \
+        of the file'''
+
+    def __init__ (self, attrs, fragments, members):
+        self.attrs = dict (attrs)
+        self.fragments = fragments
+        self.members = members
+
+    def __eq__ (self, other):
+        # Fragments are cached by the thoughts, so for an unchanged map
+        # this mostly compares the same strings
+        return isinstance (other, MapSnapshot) and \
+               self.attrs == other.attrs and \
+               self.fragments == other.fragments and \
+               [m[0] for m in self.members] == [m[0] for m in other.members]
+
+    def __ne__ (self, other):
+        return not self == other
+
+    def write_manifest (self, out):
+        writer = saxutils.XMLGenerator (out, "utf-8")
+        writer.startDocument ()
+        writer.startElement ("MMap", utils.sax_attributes (self.attrs))
+        # The writer doesn't buffer, so the cached fragments can go to
+        # out directly
+        for fragment in self.fragments:
+            out.write (fragment)
+        writer.endElement ("MMap")
+        writer.endDocument ()
+
+    def write (self, tar):
+        manifest = tempfile.TemporaryFile ()
+        try:
+            self.write_manifest (manifest)
+            tar.write ('MANIFEST', manifest)
+        finally:
+            manifest.close ()
+        for name, data in self.members:
+            if not tar.exists (name):
+                tar.write (name, data)
+
+class MapSaver (threading.Thread):
+    ''' Writes a MapSnapshot to path in a thread of its own.  The map \
+        goes to a temporary file next to path first, which is renamed \
+        over path once complete, so path never holds half a map.  \
+        done_cb (saver) is called on the main loop afterwards; error \
+        is None if everything went well.  run can also be called \
+        directly to write the map from the calling thread'''
+
+    def __init__ (self, snapshot, path, format = 'tar', done_cb = None):
+        threading.Thread.__init__ (self)
+        self.daemon = True
+        self.snapshot = snapshot
+        self.path = path
+        self.format = format
+        self.done_cb = done_cb
+        self.error = None
+        self.finished = threading.Event ()
+
+    def run (self):
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp (prefix = '.' + os.path.basename (self.path),
+                                        suffix = '.tmp',
+                                        dir = os.path.dirname (self.path) or '.')
+            os.close (fd)
+            os.chmod (tmp, 0644)
+            tar = Tarball (tmp, 'w', format = self.format)
+            try:
+                self.snapshot.write (tar)
+            finally:
+                tar.close ()
+            os.rename (tmp, self.path)
+        except Exception, e:
+            logging.error ("Can't save %s: %s" % (self.path, e))
+            self.error = sys.exc_info ()
+            if tmp and os.path.exists (tmp):
+                os.remove (tmp)
+        self.finished.set ()
+        if self.is_alive ():
+            GObject.idle_add (self.done_idle_cb)
+
+    def done_idle_cb (self):
+        if self.done_cb:
+            self.done_cb (self)
+        return False
+
+    def wait (self, timeout = None):
+        ''' True once the map has been written (or failed to) '''
+        self.finished.wait (timeout)
+        return self.finished.is_set ()
+
+    def raise_error (self):
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
@@ -0,0 +1,81 @@
+# OrderedSet.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+import collections
+
+class OrderedSet (object):
+    ''' A set that remembers the order items were added in.  It stands \
+        in for the list the selection used to be, so it also answers to \
+        append, count, pop and indexing.  Membership tests and removal \
+        don't depend on the number of items'''
+
+    def __init__ (self, items = ()):
+        self.items = collections.OrderedDict ()
+        for item in items:
+            self.items[item] = None
+
+    def __len__ (self):
+        return len(self.items)
+
+    def __iter__ (self):
+        return iter(self.items)
+
+    def __reversed__ (self):
+        return reversed(self.items)
+
+    def __contains__ (self, item):
+        return item in self.items
+
+    def __getitem__ (self, index):
+        if not self.items:
+            raise IndexError ("OrderedSet index out of range")
+        # The first and last items are by far the most asked for
+        if index == 0:
+            return next(iter(self.items))
+        if index == -1:
+            return next(reversed(self.items))
+        return list(self.items)[index]
+
+    def __copy__ (self):
+        return OrderedSet (self.items)
+
+    def __repr__ (self):
+        return "OrderedSet(%r)" % list(self.items)
+
+    def append (self, item):
+        self.items[item] = None
+
+    add = append
+
+    def remove (self, item):
+        try:
+            del self.items[item]
+        except KeyError:
+            raise ValueError ("OrderedSet.remove(x): x not in set")
+
+    def discard (self, item):
+        self.items.pop (item, None)
+
+    def count (self, item):
+        return int(item in self.items)
+
+    def pop (self):
+        if not self.items:
+            raise IndexError ("pop from empty OrderedSet")
+        return self.items.popitem ()[0]
@@ -0,0 +1,129 @@
+# RenderCache.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+import math
+import collections
+
+import cairo
+
+import utils
+
+# Room left around a thought on its surface for the outline, which is
+# stroked half outside of ul / lr
+PAD = 4
+
+def color_key (color):
+    try:
+        return tuple(utils.gtk_to_cairo_color (color))
+    except TypeError:
+        return None
+
+class RenderCache (object):
+    ''' Keeps an offscreen surface per thought with the thought already \
+        drawn on it, so unchanged thoughts are painted with one blit. \
+        A surface is only made for a thought once it has looked the same \
+        for two draws in a row - thoughts that change on every frame \
+        (being drawn on, resized) would only pay for rendering twice. \
+        The least recently used surfaces are dropped once the cache gets \
+        above budget bytes'''
+
+    def __init__ (self, budget = None):
+        if budget is None:
+            budget = utils.render_cache_budget
+        self.budget = budget
+        self.used = 0
+        self.entries = collections.OrderedDict ()
+        self.seen = {}
+
+    def key_for (self, thought, scale):
+        # Position is left out on purpose: moving a thought keeps its
+        # surface, which draw paints at wherever the thought is now.
+        # version only changes when what the thought shows does
+        return (thought.version,
+                int(round(thought.lr[0] - thought.ul[0])),
+                int(round(thought.lr[1] - thought.ul[1])),
+                color_key (thought.background_color),
+                color_key (thought.foreground_color),
+                thought.am_selected, thought.am_primary,
+                len(thought.extended_buffer.get_text ()) > 0,
+                int(round(math.log (scale) * 100)))
+
+    def draw (self, thought, context, scale):
+        ''' Paint thought onto context, from its surface if there is one. \
+            Returns False if the thought can't be cached and has to be \
+            drawn by the caller'''
+        if thought.editing or thought.creating or not thought.ul or not thought.lr:
+            self.forget (thought)
+            return False
+        key = self.key_for (thought, scale)
+        entry = self.entries.pop (thought, None)
+        if entry and entry[0] != key:
+            self.used -= entry[2]
+            entry = None
+        if not entry:
+            if self.seen.get (thought) != key:
+                self.seen[thought] = key
+                return False
+            entry = self.render (thought, context, scale, key)
+            if not entry:
+                return False
+            self.used += entry[2]
+        self.entries[thought] = entry
+        self.evict ()
+
+        x0 = thought.ul[0] - PAD
+        y0 = thought.ul[1] - PAD
+        context.save ()
+        context.translate (x0, y0)
+        context.scale (1. / scale, 1. / scale)
+        context.set_source_surface (entry[1], 0, 0)
+        context.paint ()
+        context.restore ()
+        return True
+
+    def render (self, thought, context, scale, key):
+        width = int(math.ceil((thought.lr[0] - thought.ul[0] + 2 * PAD) * scale))
+        height = int(math.ceil((thought.lr[1] - thought.ul[1] + 2 * PAD) * scale))
+        size = width * height * 4
+        if width <= 0 or height <= 0 or size > self.budget / 4:
+            return None
+        surface = context.get_target ().create_similar (cairo.CONTENT_COLOR_ALPHA,
+                                                        width, height)
+        sub = cairo.Context (surface)
+        sub.scale (scale, scale)
+        sub.translate (PAD - thought.ul[0], PAD - thought.ul[1])
+        thought.draw (sub)
+        return (key, surface, size)
+
+    def evict (self):
+        while self.used > self.budget and self.entries:
+            thought, entry = self.entries.popitem (last = False)
+            self.used -= entry[2]
+            self.seen.pop (thought, None)
+
+    def forget (self, thought):
+        entry = self.entries.pop (thought, None)
+        if entry:
+            self.used -= entry[2]
+        self.seen.pop (thought, None)
+
+    def clear (self):
+        self.entries.clear ()
+        self.seen.clear ()
+        self.used = 0
@@ -34,8 +34,8 @@ from gi.repository import Pango
 
 
 class ResourceThought (TextThought.TextThought):
-    def __init__ (self, coords, pango_context, thought_number, save, undo, loading, background_color, foreground_color):
-        super (ResourceThought, self).__init__(coords, pango_context, thought_number, save, undo, loading, background_color, foreground_color, "res_thought")
+    def __init__ (self, coords, pango_context, thought_number, undo, loading, background_color, foreground_color):
+        super (ResourceThought, self).__init__(coords, pango_context, thought_number, undo, loading, background_color, foreground_color, "res_thought")
 
         self.uri = ""
 
@@ -74,9 +74,10 @@ class ResourceThought (TextThought.TextThought):
         elif event.button == 3:
             self.emit ("popup_requested", event, 1)
             
-    def update_save (self):
-        super(ResourceThought, self).update_save()
-        self.element.setAttribute ("uri", self.uri)
+    def get_save_attributes (self):
+        attrs = super(ResourceThought, self).get_save_attributes()
+        attrs["uri"] = self.uri
+        return attrs
         
     def load (self, node):
         super(ResourceThought, self).load(node)
@@ -0,0 +1,200 @@
+# SpatialIndex.py
+# This file is part of Labyrinth
+#
+# Labyrinth is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# Labyrinth is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Labyrinth; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA  02110-1301  USA
+#
+
+import math
+
+# Size (in map coordinates) of a single bucket.  Thoughts are typically
+# around 100x70, so most of them end up in one to four cells.
+CELL_SIZE = 128.
+
+class SpatialGrid (object):
+    ''' A uniform grid of buckets used to find the objects (thoughts, links) \
+        near a point or inside a rectangle without walking all of them. \
+        Every object also gets a stamp when it is inserted.  Stamps only \
+        ever grow, so sorting by stamp gives back the order in which the \
+        objects were added - this is how the MMapArea keeps the z-order of \
+        its thoughts list.'''
+
+    def __init__ (self, cell_size = CELL_SIZE):
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        self.bounds = {}
+        self.stamps = {}
+        self.unbounded = set()
+        self.next_stamp = 0
+
+    def __len__ (self):
+        return len(self.stamps)
+
+    def __contains__ (self, obj):
+        return obj in self.stamps
+
+    def cell_range (self, bounds):
+        size = self.cell_size
+        return (int(math.floor(bounds[0] / size)), int(math.floor(bounds[1] / size)),
+                int(math.floor(bounds[2] / size)), int(math.floor(bounds[3] / size)))
+
+    def insert (self, obj, bounds):
+        ''' Add obj on top of everything else.  If it already was in \
+            the grid, it is raised to the top'''
+        self.remove (obj)
+        self.stamps[obj] = self.next_stamp
+        self.next_stamp += 1
+        self.bounds[obj] = None
+        self.unbounded.add (obj)
+        self.update (obj, bounds)
+
+    def update (self, obj, bounds):
+        ''' Move obj to new bounds, keeping its stamp.  Returns the \
+            bounds obj was stored with before'''
+        old = self.bounds.get (obj)
+        if old == bounds or obj not in self.stamps:
+            return old
+        if old is None:
+            self.unbounded.discard (obj)
+        else:
+            self.unlink (obj, old)
+        self.bounds[obj] = bounds
+        if bounds is None:
+            self.unbounded.add (obj)
+        else:
+            x0, y0, x1, y1 = self.cell_range (bounds)
+            for x in xrange (x0, x1 + 1):
+                for y in xrange (y0, y1 + 1):
+                    self.cells.setdefault ((x, y), set()).add (obj)
+        return old
+
+    def remove (self, obj):
+        if obj not in self.stamps:
+            return None
+        old = self.bounds.pop (obj)
+        del self.stamps[obj]
+        if old is None:
+            self.unbounded.discard (obj)
+        else:
+            self.unlink (obj, old)
+        return old
+
+    def unlink (self, obj, bounds):
+        x0, y0, x1, y1 = self.cell_range (bounds)
+        for x in xrange (x0, x1 + 1):
+            for y in xrange (y0, y1 + 1):
+                cell = self.cells.get ((x, y))
+                if cell is not None:
+                    cell.discard (obj)
+                    if not cell:
+                        del self.cells[(x, y)]
+
+    def clear (self):
+        self.cells.clear ()
+        self.bounds.clear ()
+        self.stamps.clear ()
+        self.unbounded.clear ()
+
+    def get_bounds (self, obj):
+        return self.bounds.get (obj)
+
+    def query_point (self, x, y):
+        ''' Returns the objects whose bounds may contain (x, y) plus all \
+            the objects without any known bounds'''
+        size = self.cell_size
+        found = set(self.unbounded)
+        cell = self.cells.get ((int(math.floor(x / size)), int(math.floor(y / size))))
+        if cell:
+            for obj in cell:
+                b = self.bounds[obj]
+                if b[0] <= x <= b[2] and b[1] <= y <= b[3]:
+                    found.add (obj)
+        return found
+
+    def query_rect (self, rect):
+        ''' Returns the objects whose bounds intersect rect \
+            (x0, y0, x1, y1) plus all the objects without known bounds'''
+        found = set(self.unbounded)
+        x0, y0, x1, y1 = self.cell_range (rect)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.cells):
+            # Cheaper to look at the occupied cells than at the empty ones
+            cells = [c for k, c in self.cells.iteritems () \
+                     if x0 <= k[0] <= x1 and y0 <= k[1] <= y1]
+        else:
+            cells = filter (None, [self.cells.get ((x, y)) for x in xrange (x0, x1 + 1) \
+                                                          for y in xrange (y0, y1 + 1)])
+        for cell in cells:
+            for obj in cell:
+                if obj in found:
+                    continue
+                b = self.bounds[obj]
+                if b[2] >= rect[0] and b[0] <= rect[2] and \
+                   b[3] >= rect[1] and b[1] <= rect[3]:
+                    found.add (obj)
+        return found
+
+    def query_change (self, old, new):
+        ''' Returns the objects that may be on a different side of a rect \
+            after it changed from old to new.  Cells lying completely \
+            inside both rects are never looked at, so the cost follows the \
+            area that changed rather than the size of the rects'''
+        union = (min(old[0], new[0]), min(old[1], new[1]),
+                 max(old[2], new[2]), max(old[3], new[3]))
+        inner = (max(old[0], new[0]), max(old[1], new[1]),
+                 min(old[2], new[2]), min(old[3], new[3]))
+        size = self.cell_size
+        # The cells that fit completely inside both rects
+        ix0 = int(math.ceil(inner[0] / size))
+        iy0 = int(math.ceil(inner[1] / size))
+        ix1 = int(math.floor(inner[2] / size)) - 1
+        iy1 = int(math.floor(inner[3] / size)) - 1
+
+        x0, y0, x1, y1 = self.cell_range (union)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.cells):
+            cells = [c for k, c in self.cells.iteritems () \
+                     if x0 <= k[0] <= x1 and y0 <= k[1] <= y1 and \
+                     not (ix0 <= k[0] <= ix1 and iy0 <= k[1] <= iy1)]
+        else:
+            cells = []
+            for x in xrange (x0, x1 + 1):
+                if ix0 <= x <= ix1:
+                    ys = range (y0, min(iy0, y1 + 1)) + range (max(iy1 + 1, y0), y1 + 1)
+                else:
+                    ys = xrange (y0, y1 + 1)
+                for y in ys:
+                    cell = self.cells.get ((x, y))
+                    if cell:
+                        cells.append (cell)
+
+        found = set(self.unbounded)
+        for cell in cells:
+            for obj in cell:
+                if obj in found:
+                    continue
+                b = self.bounds[obj]
+                if b[2] < union[0] or b[0] > union[2] or \
+                   b[3] < union[1] or b[1] > union[3]:
+                    continue
+                if b[0] > inner[0] and b[2] < inner[2] and \
+                   b[1] > inner[1] and b[3] < inner[3]:
+                    continue
+                found.add (obj)
+        return found
+
+    def sorted (self, objs, reverse = False):
+        ''' Sort objs by the order they were inserted in '''
+        stamps = self.stamps
+        return sorted ([o for o in objs if o in stamps], key = stamps.__getitem__,
+                       reverse = reverse)
@@ -24,6 +24,7 @@ from gi.repository import Pango
 from gi.repository import GObject
 
 import UndoManager
+import utils
 
 ADD_ATTR = 42
 REMOVE_ATTR = 43
@@ -36,17 +37,13 @@ class ExtendedBuffer(Gtk.TextBuffer):
                                             GObject.TYPE_NONE,
                                             (GObject.TYPE_BOOLEAN, GObject.TYPE_BOOLEAN, GObject.TYPE_BOOLEAN, Pango.FontDescription)))
 
-    def __init__(self, undo_manager, save, save_doc):
+    def __init__(self, undo_manager):
         super (Gtk.TextBuffer, self).__init__()
 
         self.undo = undo_manager
         self.connect('insert-text', self.insert_text_cb)
         self.connect_after('insert-text', self.apply_attrs_cb)
         self.connect('delete-range', self.delete_range_cb)
-        self.text_elem = save_doc.createTextNode ("Extended")
-        self.save = save_doc
-        self.element = save
-        self.element.appendChild(self.text_elem)
         self.bold_tag = self.create_tag("bold", weight=Pango.Weight.BOLD)
         self.italics_tag = self.create_tag("italics", style=Pango.Style.ITALIC)
         self.underline_tag = self.create_tag("underline", underline=Pango.Underline.SINGLE)
@@ -126,61 +123,41 @@ class ExtendedBuffer(Gtk.TextBuffer):
         self.emit("set_attrs", bold, italics, underline, None)
         return False
 
-    def update_save (self):
-        next = self.element.firstChild
-        while next:
-            m = next.nextSibling
-            if next.nodeName == "attribute":
-                self.element.removeChild (next)
-                next.unlink ()
-            next = m
-
-        self.text_elem.replaceWholeText (self.get_text())
-        mark = self.get_insert()
-        it = self.get_iter_at_mark(mark)
-        self.element.setAttribute("mark", str(it.get_offset()))
+    def get_tag_ranges (self):
+        ''' Returns (start, end, type) for every bold, italics and \
+            underline run.  end is -1 for runs going on to the end'''
+        ranges = []
         iter = self.get_start_iter()
         cur = 0
         tags = {}
-        doc = self.element.ownerDocument
         tag_table = self.get_tag_table()
         while(1):
-            if iter.begins_tag(tag_table.lookup("bold")):
-                tags["bold"] = cur
-            if iter.ends_tag(tag_table.lookup("bold")):
-                elem = doc.createElement ("attribute")
-                self.element.appendChild (elem)
-                start = tags.pop("bold")
-                elem.setAttribute("start", str(start))
-                elem.setAttribute("end", str(cur))
-                elem.setAttribute("type", "bold")
-            if iter.begins_tag(tag_table.lookup("italics")):
-                tags["italics"] = cur
-            if iter.ends_tag(tag_table.lookup("italics")):
-                elem = doc.createElement ("attribute")
-                self.element.appendChild (elem)
-                start = tags.pop("italics")
-                elem.setAttribute("start", str(start))
-                elem.setAttribute("end", str(cur))
-                elem.setAttribute("type", "italics")
-            if iter.begins_tag(tag_table.lookup("underline")):
-                tags["underline"] = cur
-            if iter.ends_tag(tag_table.lookup("underline")):
-                elem = doc.createElement ("attribute")
-                self.element.appendChild (elem)
-                start = tags.pop("underline")
-                elem.setAttribute("start", str(start))
-                elem.setAttribute("end", str(cur))
-                elem.setAttribute("type", "underline")
+            for x in ("bold", "italics", "underline"):
+                if iter.begins_tag(tag_table.lookup(x)):
+                    tags[x] = cur
+                if iter.ends_tag(tag_table.lookup(x)):
+                    ranges.append((tags.pop(x), cur, x))
             cur+=1
             if not iter.forward_char():
                 break
         for x in tags:
-            elem = doc.createElement ("attribute")
-            self.element.appendChild (elem)
-            elem.setAttribute("start", str(tags[x]))
-            elem.setAttribute("end", str(-1))
-            elem.setAttribute("type", x)
+            ranges.append((tags[x], -1, x))
+        return ranges
+
+    def get_mark_offset (self):
+        return self.get_iter_at_mark(self.get_insert()).get_offset()
+
+    def serialize (self, writer):
+        ''' Write the buffer as an Extended element to writer, a sax \
+            ContentHandler '''
+        writer.startElement("Extended",
+                            utils.sax_attributes({"mark": str(self.get_mark_offset())}))
+        writer.characters(self.get_text())
+        for start, end, x in self.get_tag_ranges():
+            attrs = {"start": str(start), "end": str(end), "type": x}
+            writer.startElement("attribute", utils.sax_attributes(attrs))
+            writer.endElement("attribute")
+        writer.endElement("Extended")
 
     def load(self, node):
         mark = None
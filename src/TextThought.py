@@ -29,7 +29,8 @@
 from gi.repository import Gtk, Gdk, Pango, PangoCairo
 
 import os
-import xml.dom
+from array import array
+from bisect import bisect_left
 
 import utils
 import BaseThought
@@ -42,19 +43,103 @@ UNDO_ADD_ATTR_SELECTION=65
 UNDO_REMOVE_ATTR=66
 UNDO_REMOVE_ATTR_SELECTION=67
 
+class ByteTable (object):
+    ''' The width (in bytes of the utf-8 text) of every character of a \
+        thought, with running totals so that byte and character indices \
+        can be converted with a binary search.  The totals are only \
+        worked out as far as they are asked for, and an edit only \
+        touches the ones from where it happened onward'''
+
+    def __init__ (self, widths = ()):
+        self.widths = array('I', widths)
+        self.prefix = array('I', [0])
+
+    @classmethod
+    def from_text (cls, text):
+        return cls ([len(c.encode ("utf-8")) for c in text])
+
+    def __len__ (self):
+        return len(self.widths)
+
+    def __getitem__ (self, bindex):
+        return self.widths[bindex]
+
+    def extend_prefix (self, bindex = None, index = None):
+        ''' Work out the running totals up to character bindex, or until \
+            they reach byte index'''
+        prefix = self.prefix
+        widths = self.widths
+        n = len(prefix) - 1
+        total = prefix[-1]
+        end = len(widths)
+        if bindex is not None:
+            end = min(end, bindex)
+        while n < end and (index is None or total < index):
+            total += widths[n]
+            prefix.append (total)
+            n += 1
+
+    def offset (self, bindex):
+        ''' Byte index of the start of character bindex '''
+        if bindex < 0 or bindex > len(self.widths):
+            raise IndexError ("ByteTable index out of range")
+        self.extend_prefix (bindex = bindex)
+        return self.prefix[bindex]
+
+    def find (self, index):
+        ''' Character index starting at byte index.  Indices that are \
+            past the end or in the middle of a character give the length'''
+        if index == 0:
+            return 0
+        self.extend_prefix (index = index)
+        prefix = self.prefix
+        bind = bisect_left (prefix, index, 1)
+        if bind < len(prefix) and prefix[bind] == index:
+            return bind
+        return len(self.widths)
+
+    def splice (self, start, end, widths = ()):
+        ''' Replace the characters from start to end (slice semantics) \
+            with ones of the given widths'''
+        start, end, step = slice (start, end).indices (len(self.widths))
+        end = max(start, end)
+        widths = array('I', widths)
+        removed = self.widths[start:end]
+        self.widths[start:end] = widths
+
+        prefix = self.prefix
+        known = len(prefix) - 1
+        if known <= start:
+            return
+        total = prefix[start]
+        totals = array('I')
+        for w in widths:
+            total += w
+            totals.append (total)
+        if known > end:
+            # Totals after the edit only move by the change in bytes
+            delta = sum(widths) - sum(removed)
+            totals.extend ([p + delta for p in prefix[end + 1:]])
+        prefix[start + 1:] = totals
+
+    def digits (self, start, end):
+        ''' The widths from start to end as a string of digits, the way \
+            they are kept in undo actions '''
+        return ''.join ([str(w) for w in self.widths[start:end]])
+
 class TextThought (ResizableThought):
-    def __init__ (self, coords, pango_context, thought_number, save, undo,
+    def __init__ (self, coords, pango_context, thought_number, undo,
               loading, background_color, foreground_color, name="thought",
               fixed=None, parent=None):
-        super(TextThought, self).__init__(coords, save, name, undo, background_color, foreground_color)
+        super(TextThought, self).__init__(coords, name, undo, background_color, foreground_color)
 
         self.index = 0
         self.end_index = 0
-        self.bytes = ""
+        self.bytes = ByteTable ()
         self.bindex = 0
-        self.text_element = save.createTextNode ("GOOBAH")
-        self.element.appendChild (self.text_element)
         self.layout = None
+        self.layout_dirty = True
+        self.layout_size = (0, 0)
         self.identity = thought_number
         self.pango_context = pango_context
         self.moving = False
@@ -104,35 +189,22 @@ class TextThought (ResizableThought):
         if bindex == 0:
             return 0
 
-        index = 0
-        for x in range(bindex):
-            index += int(self.bytes[x])
-
-        return index
+        return self.bytes.offset(bindex)
 
     def bindex_from_index(self, index):
-        if index == 0:
-            return 0
-
-        bind = 0
-        nbytes = 0
-
-        for x in self.bytes:
-            nbytes += int (x)
-            bind+=1
-            if nbytes == index:
-                break
-
-        if nbytes < index:
-            bind = len(self.bytes)
+        return self.bytes.find(index)
 
-        return bind
+    def invalidate_layout (self):
+        ''' The text or the way it looks changed, the layout has to be \
+            built again next time it is needed'''
+        self.layout_dirty = True
+        self.mark_changed ()
 
-    def recalc_text_edges (self):
-        if (not hasattr(self, "layout")):
+    def update_layout (self):
+        if not self.layout_dirty and self.layout is not None:
             return
-
         self.layout = Pango.Layout(self.pango_context)
+        self.layout.set_alignment(Pango.Alignment.CENTER)
 
         if self.textview != None:
             start, end = self.textview.get_buffer().get_bounds()
@@ -141,8 +213,17 @@ class TextThought (ResizableThought):
 
         ##self.layout.set_attributes(self.attrlist)
 
+        self.layout_size = self.layout.get_pixel_size()
+        self.layout_dirty = False
+
+    def recalc_text_edges (self):
+        if (not hasattr(self, "layout")):
+            return
+
+        self.update_layout()
+
         margin = utils.margin_required(utils.STYLE_NORMAL)
-        text_w, text_h = self.layout.get_pixel_size()
+        text_w, text_h = self.layout_size
         text_w += margin[0] + margin[2]
         text_h += margin[1] + margin[3]
 
@@ -172,8 +253,8 @@ class TextThought (ResizableThought):
         if self.index > self.end_index:
             left = self.text[:self.end_index]
             right = self.text[self.index:]
-            bleft = self.bytes[:self.b_f_i (self.end_index)]
-            bright = self.bytes[self.b_f_i (self.index):]
+            bstart = self.b_f_i (self.end_index)
+            bend = self.b_f_i (self.index)
             change = self.end_index - self.index + len(string)
             old = self.index
             self.index = self.end_index
@@ -181,23 +262,23 @@ class TextThought (ResizableThought):
         elif self.index < self.end_index:
             left = self.text[:self.index]
             right = self.text[self.end_index:]
-            bleft = self.bytes[:self.b_f_i (self.index)]
-            bright = self.bytes[self.b_f_i (self.end_index):]
+            bstart = self.b_f_i (self.index)
+            bend = self.b_f_i (self.end_index)
             change = self.index - self.end_index + len(string)
         else:
             left = self.text[:self.index]
             right = self.text[self.index:]
-            bleft = self.bytes[:self.b_f_i(self.index)]
-            bright = self.bytes[self.b_f_i(self.index):]
+            bstart = bend = self.b_f_i(self.index)
             change = len(string)
 
         self.text = left + string + right
         self.undo.add_undo (UndoManager.UndoAction (self, UndoManager.INSERT_LETTER, self.undo_text_action,
                             self.bindex, string, len(string), self.attributes, []))
         self.index += len (string)
-        self.bytes = bleft + str(len(string)) + bright
+        self.bytes.splice (bstart, bend, [len(string)])
         self.bindex = self.b_f_i (self.index)
         self.end_index = self.index
+        self.invalidate_layout()
 
     def draw (self, context):
         self.recalc_edges ()
@@ -213,7 +294,6 @@ class TextThought (ResizableThought):
         else:
             r, g ,b = utils.gtk_to_cairo_color(utils.default_colors["text"])
         context.set_source_rgb (r, g, b)
-        self.layout.set_alignment(Pango.Alignment.CENTER)
         context.move_to (textx, texty)
         ##context.show_layout (self.layout)
         if self.editing:
@@ -346,17 +426,17 @@ class TextThought (ResizableThought):
             left = self.text[:self.index]
             right = self.text[self.end_index:]
             local_text = self.text[self.index:self.end_index]
-            bleft = self.bytes[:self.b_f_i (self.index)]
-            bright = self.bytes[self.b_f_i (self.end_index):]
-            local_bytes = self.bytes[self.b_f_i (self.index):self.b_f_i (self.end_index)]
+            bstart = self.b_f_i (self.index)
+            bend = self.b_f_i (self.end_index)
+            local_bytes = self.bytes.digits (bstart, bend)
             change = -len(local_text)
         else:
             left = self.text[:self.index]
             right = self.text[self.index+int(self.bytes[self.bindex]):]
             local_text = self.text[self.index:self.index+int(self.bytes[self.bindex])]
-            bleft = self.bytes[:self.b_f_i(self.index)]
-            bright = self.bytes[self.b_f_i(self.index)+1:]
-            local_bytes = self.bytes[self.b_f_i(self.index)]
+            bstart = self.b_f_i(self.index)
+            bend = bstart + 1
+            local_bytes = self.bytes.digits (bstart, bend)
             change = -len(local_text)
 
         changes= []
@@ -367,8 +447,9 @@ class TextThought (ResizableThought):
                             self.b_f_i (self.index), local_text, len(local_text), local_bytes, old_attrs,
                             changes))
         self.text = left+right
-        self.bytes = bleft+bright
+        self.bytes.splice (bstart, bend)
         self.end_index = self.index
+        self.invalidate_layout()
 
     def backspace_char (self):
         if self.index == self.end_index == 0:
@@ -380,19 +461,19 @@ class TextThought (ResizableThought):
         if self.index != self.end_index:
             left = self.text[:self.index]
             right = self.text[self.end_index:]
-            bleft = self.bytes[:self.b_f_i (self.index)]
-            bright = self.bytes[self.b_f_i (self.end_index):]
+            bstart = self.b_f_i (self.index)
+            bend = self.b_f_i (self.end_index)
             local_text = self.text[self.index:self.end_index]
-            local_bytes = self.bytes[self.b_f_i (self.index):self.b_f_i (self.end_index)]
+            local_bytes = self.bytes.digits (bstart, bend)
             change = -len(local_text)
 
         else:
             left = self.text[:self.index-int(self.bytes[self.bindex-1])]
             right = self.text[self.index:]
-            bleft = self.bytes[:self.b_f_i(self.index)-1]
-            bright = self.bytes[self.b_f_i(self.index):]
+            bend = self.b_f_i(self.index)
+            bstart = bend - 1
             local_text = self.text[self.index-int(self.bytes[self.bindex-1]):self.index]
-            local_bytes = self.bytes[self.b_f_i(self.index)-1]
+            local_bytes = self.bytes.digits (bstart, bend)
             self.index-=int(self.bytes[self.bindex-1])
             change = -len(local_text)
 
@@ -401,8 +482,9 @@ class TextThought (ResizableThought):
         accounted = -change
 
         self.text = left+right
-        self.bytes = bleft+bright
+        self.bytes.splice (bstart, bend)
         self.end_index = self.index
+        self.invalidate_layout()
 
         self.undo.add_undo(UndoManager.UndoAction (self, UndoManager.DELETE_LETTER, self.undo_text_action,
                            self.b_f_i (self.index), local_text, len(local_text), local_bytes, old_attrs,
@@ -609,6 +691,7 @@ class TextThought (ResizableThought):
         self.textview.modify_text(Gtk.StateType.NORMAL, rgba)
 
         self.textview.get_buffer().set_text(self.text)
+        self.invalidate_layout()
         self.textview.show()
 
         if self._textview_handler is None:
@@ -622,6 +705,8 @@ class TextThought (ResizableThought):
                 'paste-clipboard', self._textview_paste_cb)
             self.select_handler = self.textview.connect(
                 'select-all', self._textview_select_cb)
+            self.changed_handler = self.textview.get_buffer().connect(
+                'changed', self._textview_changed_cb)
         self.textview.grab_focus()
         self._fixed.show()
 
@@ -693,6 +778,9 @@ class TextThought (ResizableThought):
                     buffer.get_end_iter())
         return True
 
+    def _textview_changed_cb(self, buffer):
+        self.invalidate_layout()
+
     def _textview_focus_out_cb(self, widget=None, event=None):
         self._textview_process()
         return False
@@ -768,108 +856,32 @@ class TextThought (ResizableThought):
         context.set_source_rgb (0,0,0)
         context.stroke ()
 
-    def update_save (self):
-        next = self.element.firstChild
-        while next:
-            m = next.nextSibling
-            if next.nodeName == "attribute":
-                self.element.removeChild (next)
-                next.unlink ()
-            next = m
-
-        if self.text_element.parentNode is not None:
-            self.text_element.replaceWholeText (self.text)
-        text = self.extended_buffer.get_text ()
-        if text:
-            self.extended_buffer.update_save()
-        else:
-            try:
-                self.element.removeChild(self.extended_buffer.element)
-            except xml.dom.NotFoundErr:
-                pass
-        self.element.setAttribute("cursor", str(self.index))
-        self.element.setAttribute("ul-coords", str(self.ul))
-        self.element.setAttribute("lr-coords", str(self.lr))
-        self.element.setAttribute("identity", str(self.identity))
-        self.element.setAttribute("background-color", utils.color_to_string(self.background_color))
-        self.element.setAttribute("foreground-color", utils.color_to_string(self.foreground_color))
-
-        if self.am_selected:
-                self.element.setAttribute ("current_root", "true")
-
-        else:
-            try:
-                self.element.removeAttribute ("current_root")
-
-            except xml.dom.NotFoundErr:
-                pass
-
-        if self.am_primary:
-            self.element.setAttribute ("primary_root", "true");
+    def get_save_attributes (self):
+        attrs = super (TextThought, self).get_save_attributes ()
+        attrs["cursor"] = str(self.index)
+        attrs["background-color"] = utils.color_to_string(self.background_color)
+        attrs["foreground-color"] = utils.color_to_string(self.foreground_color)
+        return attrs
 
+    def serialize_content (self, writer):
+        # While the thought is edited its text only reaches self.text
+        # when the textview goes, save what has been typed so far
+        if self.textview is not None:
+            start, end = self.textview.get_buffer().get_bounds()
+            text = self.textview.get_buffer().get_text(start, end, True)
+            writer.characters (text.decode ('utf-8'))
         else:
-            try:
-                self.element.removeAttribute ("primary_root")
-
-            except xml.dom.NotFoundErr:
-                pass
+            writer.characters (self.text)
 
-        doc = self.element.ownerDocument
-        """
-        while (1):
-            r = it.range()
-            for x in it.get_attrs():
-                if x.type == Pango.Weight and x.value == Pango.Weight.BOLD:
-                    elem = doc.createElement ("attribute")
-                    self.element.appendChild (elem)
-                    elem.setAttribute("start", str(r[0]))
-                    elem.setAttribute("end", str(r[1]))
-                    elem.setAttribute("type", "bold")
-                elif x.type == Pango.Style and x.value == Pango.Style.ITALIC:
-                    elem = doc.createElement ("attribute")
-                    self.element.appendChild (elem)
-                    elem.setAttribute("start", str(r[0]))
-                    elem.setAttribute("end", str(r[1]))
-                    elem.setAttribute("type", "italics")
-                elif x.type == Pango.Underline and x.value == Pango.Underline.SINGLE:
-                    elem = doc.createElement ("attribute")
-                    self.element.appendChild (elem)
-                    elem.setAttribute("start", str(r[0]))
-                    elem.setAttribute("end", str(r[1]))
-                    elem.setAttribute("type", "underline")
-                elif x.type == Pango.AttrFontDesc:
-                    elem = doc.createElement ("attribute")
-                    self.element.appendChild (elem)
-                    elem.setAttribute("start", str(r[0]))
-                    elem.setAttribute("end", str(r[1]))
-                    elem.setAttribute("type", "font")
-                    elem.setAttribute("value", x.desc.to_string ())
-            if not it.next():
-                break
-        """
     def rebuild_byte_table (self):
         # Build the Byte table
-        del self.bytes
-        self.bytes = ''
-        tmp = self.text.encode ("utf-8")
-        current = 0
-        for z in range(len(self.text)):
-            if str(self.text[z]) == str(tmp[current]):
-                self.bytes += '1'
-            else:
-                blen = 2
-                while 1:
-                    try:
-                        if str(tmp[current:current+blen].encode()) == str(self.text[z]):
-                            self.bytes += str(blen)
-                            current+=(blen-1)
-                            break
-                        blen += 1
-                    except:
-                        blen += 1
-            current+=1
+        text = self.text
+        if isinstance(text, str):
+            text = text.decode ("utf-8")
+        self.bytes = ByteTable.from_text (text)
+        self.text = text.encode ("utf-8")
         self.bindex = self.b_f_i (self.index)
-        self.text = tmp
+        self.invalidate_layout()
 
     def load (self, node, tar):
         self.index = 0 ##int (node.getAttribute ("cursor"))
@@ -998,6 +1010,7 @@ class TextThought (ResizableThought):
         self.preedit = imcontext.get_preedit_string ()
         if self.preedit[0] == '':
             self.preedit = None
+        self.invalidate_layout()
         self.recalc_edges ()
         self.emit ("update_view")
 
@@ -1025,6 +1038,7 @@ class TextThought (ResizableThought):
                 pass##self.attributes = action.args[1].copy()
             elif action.undo_type == UNDO_ADD_ATTR_SELECTION:
                 pass##self.attributes = action.args[1].copy()
+        self.invalidate_layout()
         self.recalc_edges()
         self.emit("update_view")
         self.undo.unblock()
@@ -1103,20 +1117,24 @@ class TextThought (ResizableThought):
                                       old_attrs,
                                       self.attributes.copy()))
             """
+        self.invalidate_layout()
         self.recalc_edges()
         self.remove_textview()
 
     def set_bold(self, active):
         self.attributes["bold"] = active
         self.apply_tags()
+        self.invalidate_layout()
 
     def set_italics(self, active):
         self.attributes["italic"] = active
         self.apply_tags()
+        self.invalidate_layout()
 
     def set_underline (self, active):
         self.attributes["underline"] = active
         self.apply_tags()
+        self.invalidate_layout()
 
     def set_font (self, font_name, font_size):
         # With textview, we are always editing
@@ -1145,6 +1163,7 @@ class TextThought (ResizableThought):
             ##                      self.undo_attr_cb,
             ##                      old_attrs,
             ##                      self.attributes.copy()))
+        self.invalidate_layout()
         self.recalc_edges()
         self.remove_textview()
 
@@ -1170,6 +1189,7 @@ class TextThought (ResizableThought):
             self.textview.hide()
             self.textview.destroy()
             self.textview = None
+            self.invalidate_layout()
 
     def leave(self):
         self.remove_textview()
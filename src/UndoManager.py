@@ -64,6 +64,7 @@ class UndoManager:
         self.redo = redo_widget
 
         self.blocked = False
+        self.changed_cb = None
 
         self.undo_list = []
         self.redo_list = []
@@ -94,6 +95,11 @@ class UndoManager:
         self.redo.connect('clicked', self.redo_action)
         self.update_sensitive ()
 
+    def set_changed_cb (self, cb):
+        ''' cb () is called whenever an action is added, undone \
+        or redone '''
+        self.changed_cb = cb
+
     def update_sensitive (self):
         if not self.undo or not self.redo:
             return
@@ -105,17 +111,24 @@ class UndoManager:
         self.redo_list.append (result)
         self.update_sensitive ()
         result.callback (result, mode=UNDO)
+        self.notify_changed ()
 
     def forget_action (self):
         result = self.undo_list.pop()
         self.update_sensitive ()
         result.callback (result, mode=UNDO)
+        self.notify_changed ()
 
     def redo_action (self, arg):
         result = self.redo_list.pop()
         self.undo_list.append (result)
         self.update_sensitive ()
         result.callback (result, mode=REDO)
+        self.notify_changed ()
+
+    def notify_changed (self):
+        if self.changed_cb:
+            self.changed_cb ()
 
     def combine_insertions (self, action):
         final_text = action.text
@@ -260,4 +273,5 @@ class UndoManager:
             self.undo_list.append (action)
 
         self.update_sensitive()
+        self.notify_changed ()
 
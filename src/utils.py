@@ -26,12 +26,22 @@
 import sys
 from os.path import *
 import os
+import tarfile
 from array import array
+import cStringIO
+from xml.sax import saxutils
+from xml.sax.xmlreader import AttributesImpl
 
 # Not available on OLPC's XO, but not needed neither
 #from Numeric import *
 
 from gi.repository import Gdk
+import cairo
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 try:
     # Sugar specific modules
@@ -47,6 +57,36 @@ def color_to_string(color):
 
     return '#%04x%04x%04x' % (color.red, color.green, color.blue)
 
+def sax_attributes(attrs):
+    ''' Wrap a dict of save attributes for a sax ContentHandler. \
+        Values are decoded so non-ascii text doesn't trip the writer'''
+    values = {}
+    for name, value in attrs.iteritems():
+        if not isinstance(value, unicode):
+            value = value.decode('utf-8')
+        values[name] = value
+    return AttributesImpl(values)
+
+def xml_fragment(serialize, *args):
+    ''' Run serialize(writer, *args) and return what it wrote, \
+        as utf-8'''
+    out = cStringIO.StringIO()
+    serialize(saxutils.XMLGenerator(out, 'utf-8'), *args)
+    return out.getvalue()
+
+def open_map(filename):
+    ''' Open the MANIFEST of the map saved in filename.  Returns the \
+        file object and the Tarball holding the map, which is None for \
+        old maps saved as plain XML'''
+    from port.tarball import Tarball
+    try:
+        tar = Tarball(filename)
+    except tarfile.ReadError:
+        return open(filename, 'r'), None
+    if tar.exists('MANIFEST'):
+        return tar.open('MANIFEST'), tar
+    return tar.open(tar.getnames()[0]), tar
+
 __BE_VERBOSE=os.environ.get('DEBUG_LABYRINTH',0)
 if __BE_VERBOSE:
     def print_debug(*data):
@@ -58,6 +98,29 @@ else:
 # FIXME: this is a no-go, but fast and efficient
 # global variables
 use_bezier_curves = True
+# Keep thoughts pre-rendered on offscreen surfaces, and how many bytes
+# those surfaces may take up in total
+use_render_cache = True
+render_cache_budget = 32 * 1024 * 1024
+# Bytes the halved copies of images (see ImageCache) may take up
+image_cache_budget = 64 * 1024 * 1024
+# Bytes of decoded full size images to keep around, and whether images
+# of a loaded map are decoded in a thread while a blank box is shown
+image_decode_budget = 128 * 1024 * 1024
+decode_images_in_background = True
+# How far (in pixels) a simplified stroke may stray from what was drawn,
+# 0 keeps every point.  Strokes of old maps are only simplified when
+# they are loaded if simplify_on_load is set
+stroke_tolerance = 0.5
+simplify_on_load = False
+# Container maps are saved in: 'tar', or 'zip' for a smaller file with
+# a compressed MANIFEST and images that can be read without a scan
+map_container = 'tar'
+# Seconds a changed map has to be left alone before it is saved, and
+# the longest a change may go unsaved while editing goes on. 0 turns
+# autosaving off
+autosave_delay = 5
+autosave_max_delay = 60
 default_colors = {
     "text" : (0.0, 0.0, 0.0),
     "fg" : (0.0, 0.0, 0.0),
@@ -251,23 +314,41 @@ def export_thought_outline (context, ul, lr, background_color, am_root = False,
     real_lr = (lr[0]+move[0], lr[1]+move[1])
     draw_thought_extended (context, real_ul, real_lr, False, am_primary, background_color, style == STYLE_EXTENDED_CONTENT)
 
-def pixbuf_to_cairo (pixel_array):
-    imgW, imgH = len(pixel_array[0]), len(pixel_array)
-    data = array('B', [0] * imgW * imgH * 4)
-    for y in range(imgH):
-        for x in range(imgW):
-            # cairo.FORMAT_ARGB32 uses pre-multiplied alpha
-            try:
-                alpha = pixel_array[y][x][3]
-            except:
-                alpha = 255
-            alpha_mul = float(alpha) / 255
-
-            offset = (x + (y * imgW)) * 4
-            data[offset] = int(int(pixel_array[y][x][2]) * alpha_mul) # B
-            data[offset+1] = int(int(pixel_array[y][x][1]) * alpha_mul) # G
-            data[offset+2] = int(int(pixel_array[y][x][0]) * alpha_mul) # R
-            data[offset+3] = alpha # A
-
-    return data
+def pixbuf_to_surface (pixbuf):
+    ''' Returns a cairo.ImageSurface with the pixels of pixbuf. \
+        With numpy the swizzle and premultiply are done over the whole \
+        buffer at once, otherwise gdk does the conversion'''
+    width = pixbuf.get_width ()
+    height = pixbuf.get_height ()
+    if numpy is None:
+        surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, width, height)
+        context = cairo.Context (surface)
+        Gdk.cairo_set_source_pixbuf (context, pixbuf, 0, 0)
+        context.set_operator (cairo.OPERATOR_SOURCE)
+        context.paint ()
+        return surface
+
+    channels = pixbuf.get_n_channels ()
+    buf = numpy.frombuffer (pixbuf.get_pixels (), dtype = numpy.uint8)
+    # The last row isn't padded to the rowstride
+    src = numpy.ndarray ((height, width, channels), numpy.uint8, buf, 0,
+                         (pixbuf.get_rowstride (), channels, 1))
+    stride = cairo.ImageSurface.format_stride_for_width (cairo.FORMAT_ARGB32, width)
+    data = numpy.empty ((height, stride / 4, 4), numpy.uint8)
+    # cairo.FORMAT_ARGB32 is native endian, with pre-multiplied alpha
+    if sys.byteorder == 'little':
+        b, g, r, a = 0, 1, 2, 3
+    else:
+        a, r, g, b = 0, 1, 2, 3
+    if channels == 4:
+        alpha = src[:, :, 3].astype (numpy.uint16)
+        for i, c in ((r, 0), (g, 1), (b, 2)):
+            data[:, :width, i] = src[:, :, c] * alpha / 255
+        data[:, :width, a] = src[:, :, 3]
+    else:
+        for i, c in ((r, 0), (g, 1), (b, 2)):
+            data[:, :width, i] = src[:, :, c]
+        data[:, :width, a] = 255
+    return cairo.ImageSurface.create_for_data (data, cairo.FORMAT_ARGB32,
+                                               width, height, stride)
 